@@ -0,0 +1 @@
+# audio/__init__.py
\ No newline at end of file
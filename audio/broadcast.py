@@ -0,0 +1,188 @@
+''' Fans the Opus packets of a single audio source out to any number of voice connections '''
+
+import asyncio
+import discord
+import logging
+import threading
+import time
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# An Opus frame of silence, sent to listeners while no audio is available
+OPUS_SILENCE = b"\xf8\xff\xfe"
+
+# The duration of a single Opus packet, in seconds
+_FRAME_LENGTH = 0.02
+
+
+class BroadcastStream():
+    ''' Reads packets from one audio source at a time, in real time, and keeps the most recent ones for its listeners.\n
+        The stream runs in its own thread, and stays alive between sources so listeners never notice track changes.
+    '''
+
+    def __init__(self, lead_packets: int, max_packets: int) -> None:
+        self._lead_packets = lead_packets
+        self._max_packets = max_packets
+
+        self._condition = threading.Condition()
+        self._packets: deque[bytes] = deque()
+        self._first_sequence = 0 # The sequence number of the oldest kept packet
+        self._source: discord.AudioSource = None
+        self._source_finished: asyncio.Future = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name="broadcast_stream", daemon=True)
+        self._thread.start()
+
+
+    @property
+    def closed(self) -> bool:
+        ''' Whether the stream has been closed. '''
+        return self._closed
+
+
+    @property
+    def next_sequence(self) -> int:
+        ''' The sequence number the next packet will have. '''
+        return self._first_sequence + len(self._packets)
+
+
+    def listen(self) -> "BroadcastListener":
+        ''' Creates an audio source playing this stream, starting from its most recent packets '''
+        return BroadcastListener(self)
+
+
+    async def play(self, source: discord.AudioSource) -> None:
+        ''' Broadcasts an audio source (which must produce Opus packets) until it ends or is stopped '''
+
+        finished = asyncio.get_running_loop().create_future()
+
+        with self._condition:
+            if self._closed:
+                source.cleanup()
+                return
+
+            self._source = source
+            self._source_finished = finished
+            self._condition.notify_all()
+
+        await finished
+
+
+    def stop_source(self) -> None:
+        ''' Stops the current source, as if it had ended '''
+
+        with self._condition:
+            self._finish_source()
+
+
+    def close(self) -> None:
+        ''' Stops the current source and ends the stream for every listener '''
+
+        with self._condition:
+            self._closed = True
+            self._finish_source()
+            self._condition.notify_all()
+
+
+    def _finish_source(self) -> None:
+        ''' Cleans up the current source and lets `play` return. Must be called while holding the condition. '''
+
+        if self._source is None:
+            return
+
+        try:
+            self._source.cleanup()
+        except Exception as err:
+            logger.warning("Ignoring exception while cleaning up a broadcast source: %s", err)
+
+        finished = self._source_finished
+        finished.get_loop().call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+        self._source = None
+        self._source_finished = None
+
+
+    def _run(self) -> None:
+        ''' Reads packets from the current source, a little ahead of real time '''
+
+        start_time = time.perf_counter()
+        packets_read = 0
+
+        while True:
+            with self._condition:
+                while self._source is None and not self._closed:
+                    self._condition.wait()
+
+                    # Start reading ahead again when a new source begins
+                    start_time = time.perf_counter()
+                    packets_read = 0
+
+                if self._closed:
+                    return
+
+                source = self._source
+
+            try:
+                packet = source.read()
+            except Exception as err:
+                logger.error("Exception occurred while reading a broadcast source: %s", err)
+                packet = b""
+
+            with self._condition:
+                if source is not self._source:
+                    continue
+
+                if not packet:
+                    self._finish_source()
+                    continue
+
+                self._packets.append(packet)
+                while len(self._packets) > self._max_packets:
+                    self._packets.popleft()
+                    self._first_sequence += 1
+
+            # Stay `lead_packets` ahead of real time
+            packets_read += 1
+            delay = start_time + _FRAME_LENGTH * (packets_read - self._lead_packets) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+    def _read(self, sequence: int) -> tuple[bytes, int]:
+        ''' Returns the packet with the given sequence number (or silence if it isn't available yet), along with the next sequence number to read.\n
+            Listeners that have fallen too far behind skip ahead to the oldest kept packet.
+        '''
+
+        with self._condition:
+            if self._closed:
+                return b"", sequence
+
+            sequence = max(sequence, self._first_sequence)
+            if sequence >= self.next_sequence:
+                return OPUS_SILENCE, sequence
+
+            return self._packets[sequence - self._first_sequence], sequence + 1
+
+
+
+class BroadcastListener(discord.AudioSource):
+    ''' An audio source playing a broadcast stream '''
+
+    def __init__(self, stream: BroadcastStream) -> None:
+        self._stream = stream
+
+        # Start behind the most recent packet by the stream's lead, so the listener has some audio buffered
+        self._sequence = max(0, stream.next_sequence - stream._lead_packets)
+
+
+    def read(self) -> bytes:
+        packet, self._sequence = self._stream._read(self._sequence)
+        return packet
+
+
+    def is_opus(self) -> bool:
+        return True
@@ -0,0 +1,165 @@
+''' A read-ahead buffer between audio sources and the voice client, recording how well playback keeps up '''
+
+import discord
+import logging
+import threading
+import time
+import weakref
+
+from collections import deque
+
+from util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# The duration of a single packet, in seconds
+_FRAME_LENGTH = 0.02
+
+# Packets requested later than this after the previous one (in seconds) count as late sends
+_LATE_SEND = 1.5 * _FRAME_LENGTH
+
+# Gaps longer than this (in seconds) between packet requests are pauses, rather than late sends
+_PAUSE = 1.0
+
+
+class ReadAheadAudio(discord.AudioSource):
+    ''' Wraps an audio source, continuously reading up to a number of packets ahead of playback in the background.\n
+        Records the time to the first packet, the buffer's fill level, underruns (the buffer running dry mid-stream)
+        and late sends (the voice client's 20 ms send loop falling behind), which are logged when the stream ends.
+    '''
+
+    def __init__(self, source: discord.AudioSource, max_packets: int, owner_id: any) -> None:
+        self._source = source
+        self._max_packets = max_packets
+        self._owner_id = owner_id
+
+        self._condition = threading.Condition()
+        self._buffer: deque[bytes] = deque()
+        self._ended = False
+        self._closed = False
+
+        # Telemetry
+        self._created = time.perf_counter()
+        self._first_packet: float = None
+        self._last_send: float = None
+        self._sends = 0
+        self._fill_total = 0
+        self._fill_min: int = None
+        self._underruns = 0
+        self._late_sends = 0
+
+        _streams.add(self)
+        metrics.increment("read-ahead-streams")
+
+        self._thread = threading.Thread(target=self._fill, name="read_ahead_buffer", daemon=True)
+        self._thread.start()
+
+
+    @property
+    def buffered(self) -> int:
+        ''' The number of packets currently buffered. '''
+        return len(self._buffer)
+
+
+    def _fill(self) -> None:
+        ''' Reads packets into the buffer until the source ends or the stream is cleaned up '''
+
+        while True:
+            with self._condition:
+                while len(self._buffer) >= self._max_packets and not self._closed:
+                    self._condition.wait()
+
+                if self._closed:
+                    return
+
+            # The source may be cleaned up (and closed) while it's being read
+            try:
+                packet = self._source.read()
+            except Exception:
+                packet = b""
+
+            with self._condition:
+                if not packet:
+                    self._ended = True
+                    self._condition.notify_all()
+                    return
+
+                if self._first_packet is None:
+                    self._first_packet = time.perf_counter()
+                    metrics.increment("read-ahead-first-packet-seconds-total", self._first_packet - self._created)
+
+                self._buffer.append(packet)
+                self._condition.notify_all()
+
+
+    def _record_send(self) -> None:
+        ''' Records the timing of a packet request from the voice client '''
+
+        now = time.perf_counter()
+
+        if self._last_send is not None and _LATE_SEND < now - self._last_send < _PAUSE:
+            self._late_sends += 1
+            metrics.increment("read-ahead-late-sends")
+
+        self._last_send = now
+
+
+    def read(self) -> bytes:
+        self._record_send()
+
+        with self._condition:
+            # The buffer running dry after playback started means the source couldn't keep up
+            if len(self._buffer) == 0 and not self._ended and not self._closed:
+                if self._sends > 0:
+                    self._underruns += 1
+                    metrics.increment("read-ahead-underruns")
+                    logger.warning("%s: Audio buffer underrun after %.1fs of playback.", self._owner_id, self._sends * _FRAME_LENGTH)
+
+                while len(self._buffer) == 0 and not self._ended and not self._closed:
+                    self._condition.wait()
+
+            if len(self._buffer) == 0:
+                return b""
+
+            fill = len(self._buffer)
+            self._fill_total += fill
+            self._fill_min = fill if self._fill_min is None else min(self._fill_min, fill)
+            self._sends += 1
+
+            packet = self._buffer.popleft()
+            self._condition.notify_all()
+
+        return packet
+
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+
+    def cleanup(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._buffer.clear()
+            self._condition.notify_all()
+
+        # Not locked, so that a blocked read in the buffering thread can't delay cleanup (which also ends that read)
+        self._source.cleanup()
+        _streams.discard(self)
+
+        first_packet = f"{(self._first_packet - self._created) * 1000:.0f}ms" if self._first_packet is not None else "never"
+        average_fill = self._fill_total / self._sends if self._sends > 0 else 0
+        logger.info("%s: Stream ended after %.1fs: first packet %s, buffer fill %.0f avg / %s min (of %s packets), %s underruns, %s late sends.",
+                    self._owner_id, self._sends * _FRAME_LENGTH, first_packet, average_fill, self._fill_min or 0, self._max_packets,
+                    self._underruns, self._late_sends)
+
+
+
+# Streams that are currently playing
+_streams: "weakref.WeakSet[ReadAheadAudio]" = weakref.WeakSet()
+
+metrics.register_gauge("read-ahead-active", lambda: len(_streams))
+metrics.register_gauge("read-ahead-min-buffered-seconds", lambda: round(min((stream.buffered for stream in list(_streams)), default=0) * _FRAME_LENGTH, 2))
@@ -0,0 +1,224 @@
+''' A persistent cache of transcoded Opus audio, allowing repeat plays to skip ffmpeg entirely '''
+
+import discord
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from discord.oggparse import OggStream
+from pathlib import Path
+from typing import IO
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+# Ogg Opus streams begin with two header packets, which aren't audio
+_OPUS_HEADER_PREFIXES = (b"OpusHead", b"OpusTags")
+
+# Allowed difference between a song's duration and the duration of its cached audio, in seconds
+_DURATION_TOLERANCE = 2
+
+
+class OpusCache():
+    ''' Stores the final (normalized & encoded) Opus stream of songs on disk, within a byte budget.\n
+        Entries are keyed by song id and the options used to encode them, and evicted least recently used first.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self._directory = Path(directory)
+        self._max_bytes = max_bytes
+
+        # Entries are added and looked up from audio player threads
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[int, float]] = {} # cache key -> (size in bytes, last access time)
+
+        self._directory.mkdir(exist_ok=True, parents=True)
+        for entry in os.scandir(self._directory):
+
+            # Remove streams that were never finished
+            if entry.name.endswith(".tmp"):
+                Path(entry.path).unlink(missing_ok=True)
+                continue
+
+            if entry.name.endswith(".ogg"):
+                stat = entry.stat()
+                self._entries[entry.name[:-4]] = (stat.st_size, stat.st_mtime)
+
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the contents of the cache. '''
+
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": sum(size for size, _ in self._entries.values())}
+
+
+    @staticmethod
+    def key(song_id: str, options: str) -> str:
+        ''' Returns the cache key for a song encoded with the given ffmpeg options '''
+        return hashlib.sha256(f"{song_id}\n{options}".encode("utf-8")).hexdigest()[:32]
+
+
+    def _path(self, key: str) -> Path:
+        ''' Returns the path the stream with the given key is stored at '''
+        return self._directory / f"{key}.ogg"
+
+
+    def lookup(self, key: str) -> str:
+        ''' Returns the path of a cached stream, or None if it isn't cached '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._entries[key] = (entry[0], time.time())
+
+        return str(self._path(key))
+
+
+    def create_temp_file(self) -> tuple[IO[bytes], str]:
+        ''' Creates a temporary file for a stream that's being cached '''
+
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        return os.fdopen(fd, "wb"), temp_path
+
+
+    def commit(self, key: str, temp_path: str) -> None:
+        ''' Moves a fully written stream into the cache, evicting the least recently used streams if over budget '''
+
+        os.replace(temp_path, self._path(key))
+
+        with self._lock:
+            self._entries[key] = (self._path(key).stat().st_size, time.time())
+
+            total_bytes = sum(size for size, _ in self._entries.values())
+            for evicted_key, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                if total_bytes <= self._max_bytes:
+                    break
+
+                self._path(evicted_key).unlink(missing_ok=True)
+                del self._entries[evicted_key]
+                total_bytes -= size
+
+
+
+class CachedOpusAudio(discord.AudioSource):
+    ''' Plays a cached Ogg Opus stream, passing its packets directly to Discord '''
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "rb")
+        self._packet_iter = OggStream(self._file).iter_packets()
+
+
+    def read(self) -> bytes:
+        for packet in self._packet_iter:
+            if not packet.startswith(_OPUS_HEADER_PREFIXES):
+                return packet
+
+        return b""
+
+
+    def is_opus(self) -> bool:
+        return True
+
+
+    def cleanup(self) -> None:
+        self._file.close()
+
+
+
+class _TeeReader():
+    ''' Wraps a stream, copying everything read from it into a file '''
+
+    def __init__(self, stream: IO[bytes], copy: IO[bytes]) -> None:
+        self._stream = stream
+        self._copy = copy
+
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._stream.read(size)
+        if data and not self._copy.closed:
+            self._copy.write(data)
+
+        return data
+
+
+
+class CachingFFmpegOpusAudio(discord.FFmpegOpusAudio):
+    ''' An `FFmpegOpusAudio` that also stores its output in the Opus cache, once the whole song has been played '''
+
+    def __init__(self, source: str, cache: OpusCache, key: str, duration: int, **kwargs) -> None:
+        super().__init__(source, **kwargs)
+
+        self._cache = cache
+        self._cache_key = key
+        self._duration = duration
+        self._packet_count = 0
+        self._copy, self._copy_path = cache.create_temp_file()
+        self._packet_iter = OggStream(_TeeReader(self._stdout, self._copy)).iter_packets()
+
+
+    def read(self) -> bytes:
+        data = super().read()
+
+        if data:
+            self._packet_count += 1
+        else:
+            self._finish_copy()
+
+        return data
+
+
+    def _finish_copy(self) -> None:
+        ''' Caches the copied stream if ffmpeg finished successfully and produced the whole song '''
+
+        if self._copy.closed:
+            return
+
+        self._copy.close()
+
+        try:
+            succeeded = self._process.wait(timeout=5) == 0
+        except subprocess.TimeoutExpired:
+            succeeded = False
+
+        # Each packet holds 20ms of audio (ignoring the two header packets)
+        complete = (self._packet_count - 2) * 0.02 >= self._duration - _DURATION_TOLERANCE
+
+        if succeeded and complete:
+            try:
+                self._cache.commit(self._cache_key, self._copy_path)
+                return
+            except OSError as err:
+                logger.warning("Failed to store a stream in the audio cache: %s", err)
+
+        Path(self._copy_path).unlink(missing_ok=True)
+
+
+    def cleanup(self) -> None:
+        # Streams that were stopped early (e.g. skipped) are incomplete, and are discarded
+        if not self._copy.closed:
+            self._copy.close()
+            Path(self._copy_path).unlink(missing_ok=True)
+
+        super().cleanup()
+
+
+
+def _create_audio_cache() -> OpusCache:
+    ''' Creates the audio cache, if it's enabled '''
+
+    if not env.AUDIO_CACHE:
+        return None
+
+    return OpusCache(env.AUDIO_CACHE_DIR, env.AUDIO_CACHE_MAX_BYTES)
+
+
+audio_cache = _create_audio_cache()
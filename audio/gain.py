@@ -0,0 +1,96 @@
+''' An in-process gain stage, applying a live volume and a normalization gain to PCM audio before it's encoded.\n
+    Requires NumPy. Run `python -m scripts.benchmark_gain` to benchmark the cost of processing a frame.
+'''
+
+import discord
+import logging
+
+from typing import Callable
+
+from audio.loudness import TARGET_TRUE_PEAK
+from util import env
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+# The highest sample value the limiter lets through (at the target true peak)
+_LIMITER_CEILING = 32767 * 10 ** (TARGET_TRUE_PEAK / 20)
+
+# How fast the limiter's gain recovers once peaks have passed, as a factor per frame (6 dB per second)
+_LIMITER_RELEASE = 10 ** (6 * 0.02 / 20)
+
+
+def apply_gain(frame: bytes, gain: float, limiter_gain: float) -> tuple[bytes, float]:
+    ''' Applies a linear gain to a frame of 16-bit stereo PCM, limiting peaks to the ceiling.\n
+        Takes the limiter's gain after the previous frame, and returns the processed frame along with the limiter's new gain.
+    '''
+
+    samples = numpy.frombuffer(frame, dtype=numpy.int16).astype(numpy.float32).reshape(-1, discord.opus.Encoder.CHANNELS)
+    samples *= gain
+
+    # The limiter reduces its gain as soon as a frame would exceed the ceiling, and slowly recovers afterwards
+    peak = float(numpy.abs(samples).max(initial=0))
+    target = min(1.0, _LIMITER_CEILING / peak) if peak > 0 else 1.0
+
+    if target < limiter_gain:
+        # Attack instantly over the whole frame, so none of its samples are clipped
+        new_limiter_gain = target
+        samples *= new_limiter_gain
+    else:
+        # Release by ramping between the previous and new gains over the frame, to avoid audible steps
+        new_limiter_gain = min(target, limiter_gain * _LIMITER_RELEASE)
+        if limiter_gain < 1.0:
+            samples *= numpy.linspace(limiter_gain, new_limiter_gain, len(samples), dtype=numpy.float32)[:, None]
+
+    numpy.clip(samples, -32768, 32767, out=samples)
+    return samples.astype(numpy.int16).tobytes(), new_limiter_gain
+
+
+
+class GainStage(discord.AudioSource):
+    ''' Wraps a PCM audio source, applying a fixed gain (in dB) along with a volume that's read for every frame, so changes apply instantly '''
+
+    def __init__(self, source: discord.AudioSource, gain: float, volume: Callable[[], float]) -> None:
+        self._source = source
+        self._gain = 10 ** (gain / 20)
+        self._volume = volume
+        self._limiter_gain = 1.0
+
+
+    def read(self) -> bytes:
+        frame = self._source.read()
+        if len(frame) != discord.opus.Encoder.FRAME_SIZE:
+            return frame
+
+        frame, self._limiter_gain = apply_gain(frame, self._gain * self._volume(), self._limiter_gain)
+        return frame
+
+
+    def is_opus(self) -> bool:
+        return False
+
+
+    def cleanup(self) -> None:
+        self._source.cleanup()
+
+
+
+def _gain_stage_enabled() -> bool:
+    ''' Checks whether the gain stage is enabled and usable '''
+
+    if not env.PCM_GAIN_STAGE:
+        return False
+
+    if numpy is None:
+        logger.warning("The PCM gain stage is enabled, but NumPy isn't installed. Falling back to ffmpeg filters.")
+        return False
+
+    return True
+
+
+gain_stage_enabled = _gain_stage_enabled()
@@ -0,0 +1,200 @@
+''' Measures the loudness of songs once, so later plays can be normalized with a fixed gain instead of a real-time loudnorm filter '''
+
+import asyncio
+import json
+import logging
+import math
+import re
+import sqlite3
+import subprocess
+import threading
+
+from pathlib import Path
+
+from audio.scheduler import transcode_scheduler
+from audio.watchdog import process_watchdog
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+# Loudness targets, in LUFS (integrated loudness) and dBTP (true peak)
+TARGET_INTEGRATED = -14.0
+TARGET_TRUE_PEAK = -1.5
+
+# Real-time normalization, used for songs that haven't been measured yet
+LOUDNORM_FILTER = f"loudnorm=I={TARGET_INTEGRATED:g}:LRA=11:TP={TARGET_TRUE_PEAK:g}"
+
+# The loudness ReplayGain values are relative to, in LUFS
+REPLAY_GAIN_REFERENCE = -18.0
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS loudness (song_id TEXT PRIMARY KEY, integrated REAL NOT NULL, true_peak REAL NOT NULL);
+"""
+
+
+def _parse_measurement(output: str) -> tuple[float, float]:
+    ''' Extracts the integrated loudness and true peak from loudnorm's JSON summary (or None if there isn't one) '''
+
+    match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", output)
+    if match is None:
+        return None
+
+    try:
+        summary: dict = json.loads(match.group(0))
+        return float(summary["input_i"]), float(summary["input_tp"])
+    except (json.JSONDecodeError, KeyError, ValueError):
+        return None
+
+
+def gain_filter(gain: float) -> str:
+    ''' Returns an ffmpeg filter applying a fixed gain (in dB) '''
+    return f"volume={gain:.2f}dB"
+
+
+def replay_gain(gain: float, peak: float=None) -> float:
+    ''' Converts a ReplayGain value into the gain (in dB) that brings a song to the target loudness without clipping '''
+
+    gain += TARGET_INTEGRATED - REPLAY_GAIN_REFERENCE
+
+    if peak is not None and peak > 0:
+        gain = min(gain, TARGET_TRUE_PEAK - 20 * math.log10(peak))
+
+    return gain
+
+
+class LoudnessStore():
+    ''' The measured loudness of songs, stored in an SQLite database and kept in memory for quick lookups '''
+
+    def __init__(self, path: str, concurrency: int) -> None:
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+
+        # The connection is shared by worker threads, so access to it is serialized
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+            rows = self._connection.execute("SELECT song_id, integrated, true_peak FROM loudness").fetchall()
+
+        self._measurements: dict[str, tuple[float, float]] = {song_id: (integrated, true_peak) for song_id, integrated, true_peak in rows}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._analyses: dict[str, asyncio.Task] = {}
+
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the measured songs and pending analyses. '''
+        return {"songs": len(self._measurements), "pending": len(self._analyses)}
+
+
+    def close(self) -> None:
+        ''' Cancels pending analyses and closes the database connection. '''
+
+        for task in self._analyses.values():
+            task.cancel()
+
+        with self._lock:
+            self._connection.close()
+
+
+    def gain(self, song_id: str) -> float:
+        ''' Returns the gain (in dB) that brings a song to the target loudness without clipping, or None if it hasn't been measured '''
+
+        measurement = self._measurements.get(song_id)
+        if measurement is None:
+            return None
+
+        integrated, true_peak = measurement
+
+        # Silent songs can't be normalized
+        if not math.isfinite(integrated) or not math.isfinite(true_peak):
+            return 0.0
+
+        return min(TARGET_INTEGRATED - integrated, TARGET_TRUE_PEAK - true_peak)
+
+
+    def normalization_filter(self, song_id: str) -> str:
+        ''' Returns the ffmpeg filter used to normalize a song: a fixed gain if it was measured, or loudnorm otherwise '''
+
+        gain = self.gain(song_id)
+        if gain is None:
+            return LOUDNORM_FILTER
+
+        return gain_filter(gain)
+
+
+    def _store(self, song_id: str, integrated: float, true_peak: float) -> None:
+        ''' Stores a measurement in the database '''
+
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO loudness (song_id, integrated, true_peak) VALUES (?, ?, ?)",
+                                     (song_id, integrated, true_peak))
+
+
+    def analyze(self, song_id: str, source: str, owner_id: any) -> None:
+        ''' Measures a song's loudness in the background, unless it's already measured or being measured.\n
+            The analysis takes a transcode slot on behalf of its owner (a guild id, or any other key), and is skipped if none is free right away.
+        '''
+
+        if song_id in self._measurements or song_id in self._analyses:
+            return
+
+        task = asyncio.create_task(self._analyze(song_id, source, owner_id), name=f"loudness_analysis_{song_id}")
+        self._analyses[song_id] = task
+        task.add_done_callback(lambda _: self._analyses.pop(song_id, None))
+
+
+    async def _analyze(self, song_id: str, source: str, owner_id: any) -> None:
+        ''' Decodes a song with ffmpeg (discarding the audio) to measure its loudness '''
+
+        async with self._semaphore:
+            # Analyses only use transcode slots no stream is waiting for; a song that can't be measured now will be on a later play
+            slot = transcode_scheduler.try_acquire(owner_id)
+            if slot is None:
+                logger.debug("%s: No transcode slot is free, not measuring song '%s' for now.", owner_id, song_id)
+                return
+
+            try:
+                process = subprocess.Popen(
+                    ["ffmpeg", "-hide_banner", "-nostats", "-nostdin", "-i", source,
+                     "-vn", "-filter:a", f"{LOUDNORM_FILTER}:print_format=json", "-f", "null", "-"],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+                transcode_scheduler.apply_policy(process)
+                watched = process_watchdog.track(process, owner_id)
+
+                try:
+                    _, stderr = await asyncio.to_thread(process.communicate)
+                except asyncio.CancelledError:
+                    process.kill()
+                    raise
+                finally:
+                    process_watchdog.untrack(watched)
+            finally:
+                slot.release()
+
+        measurement = _parse_measurement(stderr.decode(errors="ignore"))
+        if process.returncode != 0 or measurement is None:
+            logger.warning("Failed to measure the loudness of song '%s' (ffmpeg exited with code %s).", song_id, process.returncode)
+            return
+
+        await asyncio.to_thread(self._store, song_id, *measurement)
+        self._measurements[song_id] = measurement
+
+
+
+def _create_loudness_store() -> LoudnessStore:
+    ''' Creates the loudness store, if loudness analysis is enabled '''
+
+    if not env.LOUDNESS_ANALYSIS:
+        return None
+
+    try:
+        return LoudnessStore(env.LOUDNESS_DB_PATH, env.LOUDNESS_ANALYSIS_CONCURRENCY)
+    except sqlite3.Error as err:
+        logger.error("Failed to open the loudness database, songs will be normalized in real time instead.", exc_info=err)
+        return None
+
+
+loudness_store = _create_loudness_store()
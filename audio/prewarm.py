@@ -0,0 +1,70 @@
+''' Audio sources that are started ahead of time, so they can begin playing instantly '''
+
+import discord
+import threading
+
+from collections import deque
+
+
+class PrewarmedAudio(discord.AudioSource):
+    ''' Wraps an audio source, reading its first packets in the background before playback begins.\n
+        Buffering stops as soon as the source starts playing; the buffered packets are played first.
+    '''
+
+    def __init__(self, source: discord.AudioSource, max_packets: int) -> None:
+        self._source = source
+        self._max_packets = max_packets
+        self._buffer: deque[bytes] = deque()
+        self._started = False
+
+        # The wrapped source is read from both the buffering thread and the audio player thread
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._fill, name="prewarm_buffer", daemon=True)
+        self._thread.start()
+
+
+    @property
+    def buffered(self) -> int:
+        ''' The number of packets currently buffered. '''
+        return len(self._buffer)
+
+
+    def _fill(self) -> None:
+        ''' Reads packets into the buffer until it's full, the source ends, or playback begins '''
+
+        while len(self._buffer) < self._max_packets:
+            with self._lock:
+                if self._started:
+                    return
+
+                # The source may be cleaned up (and closed) while it's being read
+                try:
+                    packet = self._source.read()
+                except Exception:
+                    return
+
+                self._buffer.append(packet)
+
+            if not packet:
+                return
+
+
+    def read(self) -> bytes:
+        with self._lock:
+            self._started = True
+
+            if len(self._buffer) > 0:
+                return self._buffer.popleft()
+
+            return self._source.read()
+
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+
+    def cleanup(self) -> None:
+        # Not locked, so that a blocked read in the buffering thread can't delay cleanup (which also ends that read)
+        self._started = True
+        self._source.cleanup()
+        self._buffer.clear()
@@ -0,0 +1,198 @@
+''' A process-wide scheduler limiting the number of concurrent transcodes, shared fairly between guilds '''
+
+import asyncio
+import discord
+import logging
+import os
+import subprocess
+
+from collections import deque, OrderedDict
+
+from util import env
+from util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeSlot():
+    ''' Permission to run one transcode, held until the transcode ends '''
+
+    def __init__(self, scheduler: "TranscodeScheduler", guild_id: int) -> None:
+        self._scheduler = scheduler
+        self._loop = asyncio.get_running_loop()
+        self._released = False
+        self.guild_id = guild_id
+
+
+    def release(self) -> None:
+        ''' Releases the slot, letting the next waiting transcode start. Safe to call from any thread, and more than once. '''
+
+        if self._released:
+            return
+
+        self._released = True
+        self._loop.call_soon_threadsafe(self._scheduler._release, self)
+
+
+
+class TranscodeScheduler():
+    ''' Hands out a limited number of transcode slots.\n
+        When every slot is taken, requests wait in per-guild queues; guilds with the fewest running transcodes are served first,
+        taking turns otherwise.
+    '''
+
+    def __init__(self, max_transcodes: int, queue_timeout: float) -> None:
+        self._max_transcodes = max_transcodes
+        self._queue_timeout = queue_timeout
+        self._active: dict[int, int] = {} # guild id -> running transcodes
+        self._waiting: OrderedDict[int, deque[asyncio.Future]] = OrderedDict() # guild id -> waiting requests, in turn order
+
+
+    @property
+    def active(self) -> int:
+        ''' The number of running transcodes. '''
+        return sum(self._active.values())
+
+
+    @property
+    def queue_depth(self) -> int:
+        ''' The number of transcodes waiting for a slot. '''
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+
+    def _grant(self, guild_id: int) -> TranscodeSlot:
+        ''' Creates a slot for a guild '''
+
+        self._active[guild_id] = self._active.get(guild_id, 0) + 1
+        return TranscodeSlot(self, guild_id)
+
+
+    def _release(self, slot: TranscodeSlot) -> None:
+        ''' Frees a slot, and hands it to the next waiting request '''
+
+        self._active[slot.guild_id] -= 1
+        if self._active[slot.guild_id] == 0:
+            del self._active[slot.guild_id]
+
+        self._grant_waiting()
+
+
+    def _grant_waiting(self) -> None:
+        ''' Hands free slots to waiting requests, fairly between guilds '''
+
+        while self.active < self._max_transcodes and len(self._waiting) > 0:
+            guild_id = min(self._waiting, key=lambda guild_id: self._active.get(guild_id, 0))
+
+            # The guild's next request goes to the back of the line
+            waiters = self._waiting[guild_id]
+            waiter = waiters.popleft()
+            if len(waiters) == 0:
+                del self._waiting[guild_id]
+            else:
+                self._waiting.move_to_end(guild_id)
+
+            if not waiter.done():
+                waiter.set_result(self._grant(guild_id))
+
+
+    def _remove_waiter(self, guild_id: int, waiter: asyncio.Future) -> None:
+        ''' Removes a request that stopped waiting '''
+
+        waiters = self._waiting.get(guild_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if len(waiters) == 0:
+                del self._waiting[guild_id]
+
+
+    def try_acquire(self, guild_id: int) -> TranscodeSlot:
+        ''' Returns a transcode slot for the given guild if one is free right now (and no one is waiting for one), or None otherwise.\n
+            Meant for background work that can simply be skipped, so it never holds up (or degrades) playback.
+        '''
+
+        if self.active < self._max_transcodes and len(self._waiting) == 0:
+            return self._grant(guild_id)
+
+        return None
+
+
+    async def acquire(self, guild_id: int) -> TranscodeSlot:
+        ''' Waits for a transcode slot for the given guild.\n
+            Returns None if no slot became available in time, in which case the transcode should be degraded to be as cheap as possible.
+        '''
+
+        slot = self.try_acquire(guild_id)
+        if slot is not None:
+            return slot
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(guild_id, deque()).append(waiter)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), self._queue_timeout)
+        except asyncio.TimeoutError:
+            # A slot may have been granted just as the wait timed out
+            if waiter.done() and not waiter.cancelled():
+                return waiter.result()
+
+            metrics.increment("transcodes-degraded")
+            return None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                waiter.result().release()
+            raise
+        finally:
+            self._remove_waiter(guild_id, waiter)
+            waiter.cancel()
+
+
+    def apply_process_policy(self, source: discord.AudioSource) -> None:
+        ''' Applies the configured niceness and CPU affinity to the ffmpeg process of an audio source '''
+
+        process = getattr(source, "_process", None)
+        if process is not None:
+            self.apply_policy(process)
+
+
+    def apply_policy(self, process: subprocess.Popen) -> None:
+        ''' Applies the configured niceness and CPU affinity to an ffmpeg process '''
+
+        try:
+            if env.TRANSCODE_NICE != 0:
+                os.setpriority(os.PRIO_PROCESS, process.pid, env.TRANSCODE_NICE)
+
+            if len(env.TRANSCODE_CPUS) > 0 and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(process.pid, env.TRANSCODE_CPUS)
+        except (OSError, ValueError) as err:
+            logger.warning("Failed to apply the scheduling policy to ffmpeg process %s: %s", process.pid, err)
+
+
+
+class ScheduledAudio(discord.AudioSource):
+    ''' Wraps an audio source, releasing its transcode slot once it's cleaned up '''
+
+    def __init__(self, source: discord.AudioSource, slot: TranscodeSlot) -> None:
+        self._source = source
+        self._slot = slot
+
+
+    def read(self) -> bytes:
+        return self._source.read()
+
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+
+    def cleanup(self) -> None:
+        try:
+            self._source.cleanup()
+        finally:
+            self._slot.release()
+
+
+
+transcode_scheduler = TranscodeScheduler(env.TRANSCODE_MAX_CONCURRENT, env.TRANSCODE_QUEUE_TIMEOUT)
+
+metrics.register_gauge("transcodes-active", lambda: transcode_scheduler.active)
+metrics.register_gauge("transcodes-queued", lambda: transcode_scheduler.queue_depth)
@@ -0,0 +1,37 @@
+''' Swaps the audio source of a playing voice client, as when seeking '''
+
+import discord
+
+
+class SeekedAudio(discord.AudioSource):
+    ''' Wraps an audio source replacing another one mid-playback.\n
+        The previous source is only cleaned up once the new one is first read, as the audio thread may still be reading from it
+        (and an empty read would end playback).
+    '''
+
+    def __init__(self, source: discord.AudioSource, previous: discord.AudioSource) -> None:
+        self._source = source
+        self._previous = previous
+
+
+    def _cleanup_previous(self) -> None:
+        if self._previous is not None:
+            previous = self._previous
+            self._previous = None
+            previous.cleanup()
+
+
+    def read(self) -> bytes:
+        self._cleanup_previous()
+        return self._source.read()
+
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+
+    def cleanup(self) -> None:
+        try:
+            self._cleanup_previous()
+        finally:
+            self._source.cleanup()
@@ -0,0 +1,301 @@
+''' Supervises the ffmpeg processes spawned for audio streams, accounting for their resource usage and killing stuck or orphaned ones '''
+
+import asyncio
+import discord
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from typing import Callable
+
+from util import env
+from util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Clock ticks per second, used to convert the CPU times in /proc (None where /proc isn't available)
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") and os.path.isdir("/proc") else None
+
+
+def _read_usage(pid: int) -> tuple[int, float] | None:
+    ''' Reads the resident memory (in bytes) and total CPU time (in seconds) of a process from /proc, or None if unavailable '''
+
+    if _CLOCK_TICKS is None:
+        return None
+
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            # The command name may contain spaces, so fields are counted from the end of it
+            fields = file.read().rsplit(")", 1)[1].split()
+
+        with open(f"/proc/{pid}/statm", "r") as file:
+            resident_pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    cpu_time = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    return resident_pages * os.sysconf("SC_PAGE_SIZE"), cpu_time
+
+
+
+class WatchedProcess():
+    ''' An ffmpeg process tracked by the watchdog, along with its latest resource usage '''
+
+    def __init__(self, process: subprocess.Popen, owner_id: any, is_owned: Callable[[], bool]) -> None:
+        self.process = process
+        self.owner_id = owner_id
+        self.is_owned = is_owned
+        self.started = time.monotonic()
+
+        self.read_started: float | None = None # When the pending read began, if one is pending
+        self.orphaned_since: float | None = None
+
+        self.rss = 0
+        self.peak_rss = 0
+        self.cpu_time = 0.0
+        self.cpu_percent = 0.0
+        self._sampled: float | None = None
+
+
+    def sample(self) -> None:
+        ''' Updates the process' resource usage '''
+
+        usage = _read_usage(self.process.pid)
+        if usage is None:
+            return
+
+        now = time.monotonic()
+        rss, cpu_time = usage
+
+        if self._sampled is not None and now > self._sampled:
+            self.cpu_percent = 100 * (cpu_time - self.cpu_time) / (now - self._sampled)
+
+        self.rss = rss
+        self.peak_rss = max(self.peak_rss, rss)
+        self.cpu_time = cpu_time
+        self._sampled = now
+
+
+
+class ProcessWatchdog():
+    ''' Tracks every ffmpeg process spawned for audio, per owner (a guild id, or any other key).\n
+        Processes are killed when they're stuck (a read has waited on them for too long) or orphaned (their owner has
+        had no voice connection for too long), which also ends their streams.
+    '''
+
+    def __init__(self, stall_timeout: float) -> None:
+        self._stall_timeout = stall_timeout
+        self._lock = threading.Lock()
+        self._processes: dict[int, WatchedProcess] = {} # pid -> process
+        self._killed_stuck = 0
+        self._killed_orphaned = 0
+
+
+    @property
+    def processes(self) -> list[WatchedProcess]:
+        ''' The tracked processes. '''
+
+        with self._lock:
+            return list(self._processes.values())
+
+
+    @property
+    def stats(self) -> dict[str, any]:
+        ''' Totals across the tracked processes, and how many processes were killed. '''
+
+        processes = self.processes
+        count = len(processes)
+        rss = sum(process.rss for process in processes)
+        cpu_percent = sum(process.cpu_percent for process in processes)
+
+        return {
+            "processes": count,
+            "owners": len({process.owner_id for process in processes}),
+            "rss-mb": round(rss / 1024 / 1024, 1),
+            "cpu-percent": round(cpu_percent, 1),
+            "rss-mb-per-stream": round(rss / count / 1024 / 1024, 1) if count > 0 else 0,
+            "cpu-percent-per-stream": round(cpu_percent / count, 1) if count > 0 else 0,
+            "killed-stuck": self._killed_stuck,
+            "killed-orphaned": self._killed_orphaned
+        }
+
+
+    def watch(self, source: discord.AudioSource, owner_id: any, is_owned: Callable[[], bool]=None) -> discord.AudioSource:
+        ''' Starts tracking the ffmpeg process of an audio source, returning the source to play instead.\n
+            Sources without a process are returned unchanged. If `is_owned` is given, the process is orphaned whenever it returns False.
+        '''
+
+        process: subprocess.Popen = getattr(source, "_process", None)
+        if not isinstance(process, subprocess.Popen):
+            return source
+
+        return WatchedAudio(source, self, self.track(process, owner_id, is_owned))
+
+
+    def track(self, process: subprocess.Popen, owner_id: any, is_owned: Callable[[], bool]=None) -> WatchedProcess:
+        ''' Starts tracking an ffmpeg process that isn't read as an audio source (so it can't be stuck), until it's untracked '''
+
+        watched = WatchedProcess(process, owner_id, is_owned)
+        watched.sample()
+
+        with self._lock:
+            self._processes[process.pid] = watched
+
+        return watched
+
+
+    def untrack(self, watched: WatchedProcess) -> None:
+        ''' Stops tracking a process, logging what it cost '''
+
+        with self._lock:
+            if self._processes.get(watched.process.pid) is not watched:
+                return
+
+            del self._processes[watched.process.pid]
+
+        logger.debug("%s: ffmpeg process %s ran for %.0fs, using %.1fs of CPU time and up to %.1f MB of memory.",
+                      watched.owner_id, watched.process.pid, time.monotonic() - watched.started, watched.cpu_time,
+                      watched.peak_rss / 1024 / 1024)
+
+
+    def _kill(self, watched: WatchedProcess, reason: str) -> None:
+        ''' Kills a process, which ends its stream '''
+
+        logger.warning("%s: Killing %s ffmpeg process %s.", watched.owner_id, reason, watched.process.pid)
+
+        try:
+            watched.process.kill()
+        except OSError:
+            pass
+
+        self.untrack(watched)
+
+
+    def check(self) -> None:
+        ''' Samples every tracked process, and kills the stuck or orphaned ones '''
+
+        now = time.monotonic()
+
+        for watched in self.processes:
+            # Processes that exited are normally untracked when their stream is cleaned up, but that may never happen
+            if watched.process.poll() is not None:
+                self.untrack(watched)
+                continue
+
+            watched.sample()
+
+            read_started = watched.read_started
+            if read_started is not None and now - read_started > self._stall_timeout:
+                self._killed_stuck += 1
+                metrics.increment("ffmpeg-killed-stuck")
+                self._kill(watched, "stuck")
+                continue
+
+            # Give owners some time to reconnect before their processes are considered orphaned
+            if watched.is_owned is None or watched.is_owned():
+                watched.orphaned_since = None
+            elif watched.orphaned_since is None:
+                watched.orphaned_since = now
+            elif now - watched.orphaned_since > self._stall_timeout:
+                self._killed_orphaned += 1
+                metrics.increment("ffmpeg-killed-orphaned")
+                self._kill(watched, "orphaned")
+
+
+    async def run(self, interval: float) -> None:
+        ''' Checks the tracked processes on an interval, until cancelled '''
+
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                self.check()
+            except Exception as err:
+                logger.error("The ffmpeg watchdog failed to check its processes.", exc_info=err)
+
+
+    def kill_all(self) -> None:
+        ''' Kills every tracked process '''
+
+        for watched in self.processes:
+            self._kill(watched, "remaining")
+
+
+    def sweep_orphans(self) -> int:
+        ''' Kills ffmpeg processes left behind by a previous run of the bot (streams from the Subsonic server that were
+            re-parented to init), returning how many were killed
+        '''
+
+        if _CLOCK_TICKS is None or not env.SUBSONIC_SERVER:
+            return 0
+
+        marker = f"{env.SUBSONIC_SERVER}/rest/stream.view".encode()
+        killed = 0
+
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+
+            try:
+                with open(f"/proc/{entry}/stat", "r") as file:
+                    stat = file.read()
+                with open(f"/proc/{entry}/cmdline", "rb") as file:
+                    cmdline = file.read()
+            except OSError:
+                continue
+
+            name = stat[stat.find("(") + 1:stat.rfind(")")]
+            parent_pid = int(stat.rsplit(")", 1)[1].split()[1])
+
+            if name == "ffmpeg" and parent_pid == 1 and marker in cmdline:
+                try:
+                    os.kill(int(entry), signal.SIGKILL)
+                    killed += 1
+                except OSError:
+                    pass
+
+        if killed > 0:
+            logger.warning("Killed %s ffmpeg processes left behind by a previous run.", killed)
+
+        return killed
+
+
+
+class WatchedAudio(discord.AudioSource):
+    ''' Wraps an audio source whose process is tracked by the watchdog, recording pending reads '''
+
+    def __init__(self, source: discord.AudioSource, watchdog: ProcessWatchdog, watched: WatchedProcess) -> None:
+        self._source = source
+        self._watchdog = watchdog
+        self._watched = watched
+
+
+    def read(self) -> bytes:
+        self._watched.read_started = time.monotonic()
+        try:
+            return self._source.read()
+        finally:
+            self._watched.read_started = None
+
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+
+    def cleanup(self) -> None:
+        try:
+            self._source.cleanup()
+        finally:
+            self._watchdog.untrack(self._watched)
+
+
+
+process_watchdog = ProcessWatchdog(env.FFMPEG_STALL_TIMEOUT)
+
+metrics.register_gauge("ffmpeg-processes", lambda: process_watchdog.stats["processes"])
+metrics.register_gauge("ffmpeg-rss-mb", lambda: process_watchdog.stats["rss-mb"])
+metrics.register_gauge("ffmpeg-cpu-percent", lambda: process_watchdog.stats["cpu-percent"])
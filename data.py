@@ -4,6 +4,7 @@
     TODO: Save one properties pickle file per-guild, instead of saving all in one file at once
 '''
 
+import copy
 import logging
 import os
 import pickle
@@ -26,7 +27,7 @@ class GuildData():
     ''' Class that holds all Submeister data specific to a guild (not saved to disk) '''
 
     def __init__(self, guild_id: int) -> None:
-        self._data = _default_data
+        self._data = copy.deepcopy(_default_data)
         self._guild_id = guild_id
         self.player = Player(guild_id)
         if self.player.queue is None:
@@ -82,10 +83,29 @@ class AutoplayMode(Enum):
     PLAYLIST: Final[int] = 3
 
 
+class NormalizationMode(Enum):
+    ''' Enum representing a loudness normalization mode '''
+    OFF: Final[int] = 0
+    TRACK: Final[int] = 1
+    ALBUM: Final[int] = 2
+    LOUDNORM: Final[int] = 3
+
+
+class QualityTier(Enum):
+    ''' Enum representing a stream quality tier '''
+    AUTO: Final[int] = 0
+    LOW: Final[int] = 1
+    MEDIUM: Final[int] = 2
+    HIGH: Final[int] = 3
+
+
 _default_properties: dict[str, Any] = {
     "queue": None,
     "autoplay-mode": AutoplayMode.NONE,
-    "autoplay-source-id": ""
+    "autoplay-source-id": "",
+    "normalization-mode": NormalizationMode.TRACK,
+    "quality-tier": QualityTier.AUTO,
+    "volume": 1.0
 }
 
 
@@ -94,7 +114,7 @@ class GuildProperties():
     ''' Class that holds all Submeister properties specific to a guild (saved to disk) '''
 
     def __init__(self) -> None:
-        self._properties = _default_properties
+        self._properties = copy.deepcopy(_default_properties)
 
 
     @property
@@ -119,6 +139,39 @@ class GuildProperties():
         self._properties["autoplay-source-id"] = value
 
 
+    @property
+    def normalization_mode(self) -> NormalizationMode:
+        ''' The loudness normalization mode in use by this guild. '''
+        return self._properties["normalization-mode"]
+
+
+    @normalization_mode.setter
+    def normalization_mode(self, value: NormalizationMode) -> None:
+        self._properties["normalization-mode"] = value
+
+
+    @property
+    def quality_tier(self) -> QualityTier:
+        ''' The quality tier streams are encoded at in this guild (where `AUTO` follows the voice channel's bitrate). '''
+        return self._properties["quality-tier"]
+
+
+    @quality_tier.setter
+    def quality_tier(self, value: QualityTier) -> None:
+        self._properties["quality-tier"] = value
+
+
+    @property
+    def volume(self) -> float:
+        ''' The playback volume of this guild, as a factor (only applied by the PCM gain stage). '''
+        return self._properties["volume"]
+
+
+    @volume.setter
+    def volume(self, value: float) -> None:
+        self._properties["volume"] = value
+
+
     @property
     def queue(self) -> list[Song]:
         '''  The queue last stored to disk for this guild. '''
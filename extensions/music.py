@@ -1,20 +1,31 @@
 ''' An extention allowing for music playback functionality '''
 
+import asyncio
 import logging
 import discord
+import time
 
 from discord import app_commands
 from discord.ext import commands
 
 import data
 import player
+import station
 import subsonic.backend as backend
 import ui
 
+from audio.gain import gain_stage_enabled
 from submeister import SubmeisterClient
+from subsonic.song import Song
+from subsonic.suggestions import song_suggestions
+from util import env
+from util.paging import PageCache
 
 logger = logging.getLogger(__name__)
 
+# Autocomplete suggestions for /play identify the chosen song by its id, marked with this prefix
+SONG_ID_PREFIX = "song-id:"
+
 
 class MusicCog(commands.Cog):
     ''' A Cog containing music playback commands '''
@@ -24,6 +35,7 @@ class MusicCog(commands.Cog):
 
     def __init__(self, bot: SubmeisterClient):
         self.bot = bot
+        self.autocomplete_requests: dict[int, int] = {}
 
 
     async def get_voice_client(self, interaction: discord.Interaction, *, should_connect: bool=False) -> discord.VoiceClient:
@@ -65,16 +77,33 @@ class MusicCog(commands.Cog):
         if query is None:
 
             # Display error if queue is empty & autoplay is disabled
-            if player.queue == [] and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE:
+            if (player.queue == [] and player.interrupted_song is None
+                    and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE):
                 return await ui.ErrMsg.queue_is_empty(interaction)
 
             # Begin playback of queue
             await ui.SysMsg.starting_queue_playback(interaction)
             await player.play_audio_queue(interaction, voice_client)
 
+        elif query.startswith(SONG_ID_PREFIX):
+            # A song was chosen from the autocomplete suggestions, so it can be played without searching again
+            song_id = query[len(SONG_ID_PREFIX):]
+            song_json = song_suggestions.get(song_id)
+            song = Song(song_json) if song_json is not None else await backend.get_song(song_id)
+
+            if song is None:
+                await ui.ErrMsg.msg(interaction, "The selected track could not be found.")
+                return
+
+            song.username = interaction.user.display_name
+            player.queue.append(song)
+
+            await ui.SysMsg.added_to_queue(interaction, song)
+            await player.play_audio_queue(interaction, voice_client)
+
         else:
             # Send our query to the subsonic API and retrieve a list of 1 song
-            songs = backend.search(query, artist_count=0, album_count=0, song_count=1)
+            songs = await backend.search(query, artist_count=0, album_count=0, song_count=1)
 
             # Display an error if the query returned no results
             if len(songs) == 0:
@@ -92,6 +121,40 @@ class MusicCog(commands.Cog):
                 await player.update_now_playing(interaction, force_create=True)
 
 
+    @play.autocomplete("query")
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggests tracks matching what the user has typed so far '''
+
+        start_time = time.monotonic()
+
+        # Debounce: only answer the latest request from each user
+        request_id = self.autocomplete_requests.get(interaction.user.id, 0) + 1
+        self.autocomplete_requests[interaction.user.id] = request_id
+        await asyncio.sleep(env.AUTOCOMPLETE_DEBOUNCE)
+
+        if self.autocomplete_requests.get(interaction.user.id) != request_id:
+            return []
+
+        del self.autocomplete_requests[interaction.user.id]
+
+        # Suggest recently seen songs first, searching for more only if there's time left before the deadline
+        songs = [Song(item) for item in song_suggestions.lookup(current, 25)]
+        time_left = env.AUTOCOMPLETE_DEADLINE - (time.monotonic() - start_time)
+
+        if len(songs) < 25 and current.strip() != "" and time_left > 0:
+            try:
+                results = await asyncio.wait_for(backend.search(current, artist_count=0, album_count=0, song_count=25), timeout=time_left)
+            except Exception as err:
+                logger.debug("Autocomplete search for '%s' didn't complete in time: %s", current, err)
+                results = []
+
+            song_ids = {song.song_id for song in songs}
+            songs += [song for song in results if song.song_id not in song_ids][:25 - len(songs)]
+
+        return [app_commands.Choice(name=ui.truncate(f"{song.title} - {song.artist}", 100), value=f"{SONG_ID_PREFIX}{song.song_id}")
+                for song in songs]
+
+
     @app_commands.command(name="search", description="Search for a track.")
     @app_commands.describe(query="Enter a search query")
     async def search(self, interaction: discord.Interaction, query: str) -> None:
@@ -105,8 +168,14 @@ class MusicCog(commands.Cog):
         song_count = 10
         song_offset = 0
 
+        # Pages of search results are kept for as long as the view is active, and neighbouring pages are fetched ahead of time
+        async def fetch_page(offset: int) -> list[Song]:
+            return await backend.search(query, artist_count=0, album_count=0, song_count=song_count, song_offset=offset)
+
+        pages = PageCache(fetch_page)
+
         # Send our query to the Subsonic API and retrieve a list of songs
-        songs = backend.search(query, artist_count=0, album_count=0, song_count=song_count, song_offset=song_offset)
+        songs = await pages.get(song_offset)
 
         # Display an error if the query returned no results
         if len(songs) == 0:
@@ -116,6 +185,13 @@ class MusicCog(commands.Cog):
         # Create a view for our response
         view = discord.ui.View()
 
+
+        # Forget the cached pages once the view can no longer be interacted with
+        async def view_timed_out() -> None:
+            pages.clear()
+
+        view.on_timeout = view_timed_out
+
         # Create a select menu option for each of our results
         select_options = ui.parse_search_as_track_selection_options(songs)
 
@@ -142,7 +218,7 @@ class MusicCog(commands.Cog):
             await ui.SysMsg.added_to_queue(interaction, selected_song)
 
             # Fetch the cover art in advance
-            backend.get_album_art_file(selected_song.cover_id, interaction.guild_id)
+            player.prefetch_covers([selected_song])
 
             # Finally, play the queue
             await player.play_audio_queue(interaction, voice_client)
@@ -172,9 +248,9 @@ class MusicCog(commands.Cog):
             elif interaction.data["custom_id"] == "next_button":
                 song_offset += song_count
 
-            # Send our query to the Subsonic API and retrieve a list of songs, backing up the previous page's songs first
+            # Retrieve this page's songs (usually already fetched in advance), backing up the previous page's songs first
             songs_lastpage = songs
-            songs = backend.search(query, artist_count=0, album_count=0, song_count=song_count, song_offset=song_offset)
+            songs = await pages.get(song_offset)
 
             # If there are no results on this page, go back one page and don't update the response
             if len(songs) == 0:
@@ -198,6 +274,9 @@ class MusicCog(commands.Cog):
             # Update the message to show the new search results
             await interaction.response.edit_message(embed=song_list, view=view)
 
+            # Fetch the next page in advance
+            pages.prefetch(song_offset + song_count)
+
 
         # Assign the page_changed callback to the page navigation buttons
         prev_button.callback = page_changed
@@ -209,6 +288,9 @@ class MusicCog(commands.Cog):
         # Show our song selection menu
         await interaction.response.send_message(embed=song_list, view=view, ephemeral=True)
 
+        # Fetch the next page in advance
+        pages.prefetch(song_offset + song_count)
+
 
     @app_commands.command(name="stop", description="Stop playing the current track.")
     async def stop(self, interaction: discord.Interaction) -> None:
@@ -302,8 +384,12 @@ class MusicCog(commands.Cog):
         if interaction.user.voice is None:
             return await ui.ErrMsg.user_not_in_voice_channel(interaction)
 
-        queue = data.guild_data(interaction.guild_id).player.queue
-        queue.clear()
+        player = data.guild_data(interaction.guild_id).player
+        player.queue.clear()
+
+        # Covers (and the prepared audio) of the cleared songs are no longer needed
+        player.cancel_cover_prefetch()
+        player.discard_prewarmed_source()
 
         # Let the user know that the queue has been cleared
         await ui.SysMsg.queue_cleared(interaction)
@@ -337,6 +423,49 @@ class MusicCog(commands.Cog):
         await ui.SysMsg.skipping(interaction)
 
 
+    @app_commands.command(name="seek", description="Jump to a position in the current track.")
+    @app_commands.describe(position="The position to jump to, as seconds or mm:ss")
+    async def seek(self, interaction: discord.Interaction, position: str) -> None:
+        ''' Seek within the current track '''
+
+        # Check if user is in voice channel
+        if interaction.user.voice is None:
+            return await ui.ErrMsg.user_not_in_voice_channel(interaction)
+
+        await interaction.response.defer(thinking=False)
+        voice_client = await self.get_voice_client(interaction)
+
+        # Check if the bot is connected to a voice channel
+        if voice_client is None:
+            await ui.ErrMsg.bot_not_in_voice_channel(interaction)
+            return
+
+        # Check if the bot is playing music (stations can't be seeked, as they're shared)
+        player = data.guild_data(interaction.guild_id).player
+        if not (voice_client.is_playing() or voice_client.is_paused()) or player.current_song is None or player.station is not None:
+            await ui.ErrMsg.not_playing(interaction)
+            return
+
+        # Parse the position, given either in seconds or as [hh:]mm:ss
+        try:
+            seconds = 0
+            for part in position.strip().split(":"):
+                seconds = seconds * 60 + int(part)
+        except ValueError:
+            await ui.ErrMsg.msg(interaction, f"**{position}** is not a valid position. Use seconds or mm:ss.")
+            return
+
+        if seconds < 0 or seconds >= player.current_song.duration:
+            await ui.ErrMsg.msg(interaction, f"**{position}** is outside the current track.")
+            return
+
+        await player.seek(interaction, voice_client, seconds)
+
+        # Display confirmation message, and update the now-playing bar to match
+        await ui.SysMsg.msg(interaction, f"{interaction.user.display_name} jumped to {seconds // 60:02d}:{seconds % 60:02d}")
+        await player.update_now_playing()
+
+
     @app_commands.command(name="now-playing", description="Show the currently playing track.")
     async def now_playing(self, interaction: discord.Interaction) -> None:
         ''' Display the player controls & details for the currently playing song. '''
@@ -383,6 +512,136 @@ class MusicCog(commands.Cog):
             player = data.guild_data(interaction.guild_id).player
             await player.play_audio_queue(interaction, voice_client)
 
+
+    @app_commands.command(name="normalization", description="Controls how the loudness of tracks is normalized.")
+    @app_commands.describe(mode="Determines the method to use when normalizing tracks")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="Track", value="track"),
+        app_commands.Choice(name="Album", value="album"),
+        app_commands.Choice(name="Loudnorm", value="loudnorm"),
+        app_commands.Choice(name="Off", value="off"),
+    ])
+    async def normalization(self, interaction: discord.Interaction, mode: app_commands.Choice[str]) -> None:
+        ''' Sets the normalization mode '''
+
+        # Update the normalization properties
+        match mode.value:
+            case "track":
+                data.guild_properties(interaction.guild_id).normalization_mode = data.NormalizationMode.TRACK
+            case "album":
+                data.guild_properties(interaction.guild_id).normalization_mode = data.NormalizationMode.ALBUM
+            case "loudnorm":
+                data.guild_properties(interaction.guild_id).normalization_mode = data.NormalizationMode.LOUDNORM
+            case "off":
+                data.guild_properties(interaction.guild_id).normalization_mode = data.NormalizationMode.OFF
+
+        # Display message indicating the new normalization mode, which applies from the next track onwards
+        if mode.value == "off":
+            await ui.SysMsg.msg(interaction, f"Normalization disabled by {interaction.user.display_name}", "Takes effect from the next track.")
+        else:
+            await ui.SysMsg.msg(interaction, f"Normalization mode set by {interaction.user.display_name}", f"Normalization mode: **{mode.name}**\nTakes effect from the next track.")
+
+
+    @app_commands.command(name="quality", description="Controls the quality tracks are streamed at.")
+    @app_commands.describe(tier="Determines the bitrate to stream at")
+    @app_commands.choices(tier=[
+        app_commands.Choice(name="Auto", value="auto"),
+        app_commands.Choice(name="Low", value="low"),
+        app_commands.Choice(name="Medium", value="medium"),
+        app_commands.Choice(name="High", value="high"),
+    ])
+    async def quality(self, interaction: discord.Interaction, tier: app_commands.Choice[str]) -> None:
+        ''' Sets the quality tier '''
+
+        # Update the quality properties
+        match tier.value:
+            case "auto":
+                data.guild_properties(interaction.guild_id).quality_tier = data.QualityTier.AUTO
+            case "low":
+                data.guild_properties(interaction.guild_id).quality_tier = data.QualityTier.LOW
+            case "medium":
+                data.guild_properties(interaction.guild_id).quality_tier = data.QualityTier.MEDIUM
+            case "high":
+                data.guild_properties(interaction.guild_id).quality_tier = data.QualityTier.HIGH
+
+        # Display message indicating the new quality tier, which applies from the next track onwards
+        if tier.value == "auto":
+            await ui.SysMsg.msg(interaction, f"Quality set by {interaction.user.display_name}", "Streams match the voice channel's bitrate.\nTakes effect from the next track.")
+        else:
+            await ui.SysMsg.msg(interaction, f"Quality set by {interaction.user.display_name}", f"Quality: **{tier.name}** (up to the voice channel's bitrate)\nTakes effect from the next track.")
+
+
+    @app_commands.command(name="volume", description="Sets the playback volume.")
+    @app_commands.describe(percent="The volume, from 0 to 200 percent")
+    async def volume(self, interaction: discord.Interaction, percent: app_commands.Range[int, 0, 200]) -> None:
+        ''' Sets the volume, which applies instantly to the current track '''
+
+        # Volume is only applied by the gain stage
+        if not gain_stage_enabled:
+            await ui.ErrMsg.msg(interaction, "Volume control isn't enabled on this bot.")
+            return
+
+        data.guild_properties(interaction.guild_id).volume = percent / 100
+
+        await ui.SysMsg.msg(interaction, f"Volume set by {interaction.user.display_name}", f"Volume: **{percent}%**")
+
+
+    @app_commands.command(name="station", description="Joins or leaves the shared station playing this server's autoplay playlist.")
+    @app_commands.describe(action="Whether to join or leave the station")
+    @app_commands.choices(action=[
+        app_commands.Choice(name="Join", value="join"),
+        app_commands.Choice(name="Leave", value="leave"),
+    ])
+    async def station(self, interaction: discord.Interaction, action: app_commands.Choice[str]) -> None:
+        ''' Joins or leaves a station, where every listening server hears the same playlist from a single stream '''
+
+        # Check if user is in voice channel
+        if interaction.user.voice is None:
+            return await ui.ErrMsg.user_not_in_voice_channel(interaction)
+
+        player = data.guild_data(interaction.guild_id).player
+
+        if action.value == "leave":
+            if player.station is None:
+                await ui.ErrMsg.msg(interaction, "Not currently listening to a station.")
+                return
+
+            player.station.unsubscribe(interaction.guild_id)
+            player.station = None
+            player.current_song = None
+
+            await ui.SysMsg.msg(interaction, f"{interaction.user.display_name} left the station")
+            return
+
+        # Stations play the playlist used as the autoplay source
+        properties = data.guild_properties(interaction.guild_id)
+        if properties.autoplay_mode is not data.AutoplayMode.PLAYLIST or properties.autoplay_source_id == "":
+            await ui.ErrMsg.msg(interaction, "Select a playlist as the Autoplay source (using /playlists) before joining its station.")
+            return
+
+        if player.station is not None:
+            await ui.ErrMsg.msg(interaction, "Already listening to a station.")
+            return
+
+        voice_client = await self.get_voice_client(interaction, should_connect=True)
+        if voice_client is None:
+            return
+
+        # Stop regular playback; the station takes over the voice connection (the queue is kept for later)
+        player.station = station.get_station(properties.autoplay_source_id)
+        player.cancel_prewarm()
+        voice_client.stop()
+
+        player.now_playing_channel = interaction.channel
+        player.station.subscribe(interaction.guild_id, voice_client)
+
+        await ui.SysMsg.msg(interaction, f"{interaction.user.display_name} joined the station",
+                            f"Listening along with {len(player.station.listeners) - 1} other server(s).")
+
+        if player.current_song is not None:
+            await player.update_now_playing(force_create=True)
+
+
     @app_commands.command(name="playlists", description="Lists available playlists.")
     async def playlists(self, interaction: discord.Interaction) -> None:
         ''' List available playlists and add them to queue/autoplay '''
@@ -396,7 +655,7 @@ class MusicCog(commands.Cog):
         playlist_offset = 0
 
         # Query the Subsonic API for a list of avaliable playlists
-        playlists = backend.get_playlists()
+        playlists = await backend.get_playlists()
 
         # Select a few of them to display at once
         displayed_playlists = playlists[playlist_offset:playlist_offset + playlist_count]
@@ -424,7 +683,7 @@ class MusicCog(commands.Cog):
             # Get the selected playlist (and its contents)
             selected_playlist = playlists[playlist_offset + int(playlist_selector.values[0])]
             selected_playlist.username = interaction.user.display_name
-            selected_playlist.songs = backend.get_songs_in_playlist(selected_playlist.playlist_id)
+            selected_playlist.songs = await backend.get_songs_in_playlist(selected_playlist.playlist_id)
 
             # Set up a fresh view for the playlist mode selecetion
             view.clear_items()
@@ -453,6 +712,9 @@ class MusicCog(commands.Cog):
                     player.queue += selected_playlist.songs
                     await ui.SysMsg.added_playlist_to_queue(interaction, selected_playlist)
 
+                    # Fetch the covers in advance, so track changes don't have to wait on them
+                    player.prefetch_covers(selected_playlist.songs)
+
                     # Play the queue
                     voice_client = await self.get_voice_client(interaction, should_connect=True)
                     await player.play_audio_queue(interaction, voice_client)
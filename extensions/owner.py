@@ -2,13 +2,23 @@
 
 import logging
 import discord
+import time
 
 from discord import app_commands
 from discord.ext import commands
 
+import subsonic.backend as backend
+import ui
+
+from audio.cache import audio_cache
+from audio.loudness import loudness_store
+from audio.watchdog import process_watchdog
 from submeister import SubmeisterClient
+from subsonic.covers import cover_store
+from subsonic.library import library_index
 
 from util import env
+from util.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -112,6 +122,68 @@ class OwnerCog(commands.GroupCog, group_name="owner"):
             await interaction.edit_original_response(content=f"Extension `{extension}` loaded successfully.")
 
 
+    @app_commands.command(name="cache-stats")
+    async def cache_stats(self, interaction: discord.Interaction):
+        '''Shows statistics for the Subsonic response, cover art, thumbnail & audio caches'''
+
+        if not await self.is_owner(interaction):
+            return
+
+        stats = "Responses:\n" + "\n".join(f"  {name}: {value}" for name, value in backend.response_cache.stats.items())
+        stats += "\nCover art:\n" + "\n".join(f"  {name}: {value}" for name, value in cover_store.stats.items())
+        stats += "\nThumbnails:\n" + "\n".join(f"  {name}: {value}" for name, value in ui.thumbnail_cache.stats.items())
+
+        if library_index is not None:
+            stats += "\nLibrary index:\n" + "\n".join(f"  {name}: {value}" for name, value in library_index.stats.items())
+
+        if audio_cache is not None:
+            stats += "\nAudio:\n" + "\n".join(f"  {name}: {value}" for name, value in audio_cache.stats.items())
+
+        if loudness_store is not None:
+            stats += "\nLoudness:\n" + "\n".join(f"  {name}: {value}" for name, value in loudness_store.stats.items())
+        await interaction.response.send_message(content=f"```\n{stats}\n```", ephemeral=True)
+
+
+    @app_commands.command(name="clear-cache")
+    async def clear_cache(self, interaction: discord.Interaction):
+        '''Clears the Subsonic response cache'''
+
+        if not await self.is_owner(interaction):
+            return
+
+        removed = backend.invalidate_cache()
+        logger.info("Subsonic response cache cleared (%s entries removed).", removed)
+        await interaction.response.send_message(content=f"Cleared `{removed}` cached responses.", ephemeral=True)
+
+
+    @app_commands.command(name="metrics")
+    async def show_metrics(self, interaction: discord.Interaction):
+        '''Shows playback metrics, such as the number of running and queued transcodes'''
+
+        if not await self.is_owner(interaction):
+            return
+
+        stats = "\n".join(f"{name}: {value}" for name, value in metrics.snapshot().items())
+        await interaction.response.send_message(content=f"```\n{stats}\n```", ephemeral=True)
+
+
+    @app_commands.command(name="processes")
+    async def show_processes(self, interaction: discord.Interaction):
+        '''Shows the ffmpeg processes streaming audio, and what each of them costs'''
+
+        if not await self.is_owner(interaction):
+            return
+
+        stats = "\n".join(f"{name}: {value}" for name, value in process_watchdog.stats.items())
+
+        # List the most expensive processes (as many as fit in a message)
+        for watched in sorted(process_watchdog.processes, key=lambda watched: watched.cpu_percent, reverse=True)[:20]:
+            stats += (f"\n  {watched.owner_id} (pid {watched.process.pid}): {time.monotonic() - watched.started:.0f}s, "
+                      f"{watched.rss / 1024 / 1024:.1f} MB, {watched.cpu_percent:.1f}% CPU, {watched.cpu_time:.1f}s CPU time")
+
+        await interaction.response.send_message(content=f"```\n{stats}\n```", ephemeral=True)
+
+
 async def setup(bot: SubmeisterClient):
     '''Setup function for the owner.py cog'''
 
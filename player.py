@@ -1,7 +1,9 @@
 ''' A player object that handles playback and data for its respective guild '''
 
 import asyncio
+import copy
 import discord
+import json
 import logging
 import random
 import time
@@ -10,11 +12,24 @@ import data
 import ui
 import util.discord
 
-from typing import cast
+from util import env
+from util.metrics import metrics
+from util.refresh import now_playing_scheduler
+
+from typing import Callable, cast
 from subsonic.song import Song
 from subsonic.playlist import Playlist
 import subsonic.backend as backend
 
+from audio.buffer import ReadAheadAudio
+from audio.cache import audio_cache, CachedOpusAudio, CachingFFmpegOpusAudio
+from audio.gain import gain_stage_enabled, GainStage
+from audio.loudness import gain_filter, loudness_store, replay_gain, LOUDNORM_FILTER
+from audio.prewarm import PrewarmedAudio
+from audio.scheduler import transcode_scheduler, ScheduledAudio
+from audio.seek import SeekedAudio
+from audio.watchdog import process_watchdog
+
 logger = logging.getLogger(__name__)
 
 # Default player data
@@ -25,19 +40,279 @@ _default_data: dict[str, any] = {
     "last-start-time": 0,
     "paused": False,
     "now-playing-message": None,
-    "now-playing-update-task": None,
+    "now-playing-lock": None,
     "now-playing-channel": None,
     "now-playing-last-song": None,
+    "now-playing-cover-id": None,
+    "now-playing-thumbnail": None,
+    "now-playing-fingerprint": None,
     "queue": [],
-    "autoplay-source": None
+    "autoplay-source": None,
+    "cover-prefetch-tasks": set(),
+    "prewarm-task": None,
+    "prewarmed-song": None,
+    "prewarmed-source": None,
+    "station": None,
+    "interrupted-song": None
 }
 
+# ffmpeg input options for streams from the Subsonic server
+_STREAM_INPUT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+# Now-playing messages taking longer than this (in seconds) to send or edit have most likely waited on Discord's rate limits,
+# which discord.py waits out instead of raising an error
+_SLOW_NOW_PLAYING_EDIT = 1.0
+
+# Steps (in seconds) the elapsed time on the now-playing message may be rounded down to, from finest to coarsest
+_ELAPSED_STEPS = (1, 5, 10, 15, 20, 30, 60)
+
+# Bounds of the bitrates (in kbps) streams are encoded at, and the bitrate used when the voice channel is unknown
+_MIN_BITRATE = 16
+_MAX_BITRATE = 512
+_DEFAULT_BITRATE = 64
+
+
+def get_normalization_filter(song: Song, normalization_mode: "data.NormalizationMode") -> str:
+    ''' Returns the ffmpeg filter used to normalize a song's loudness (or None if it shouldn't be normalized) '''
+
+    match normalization_mode:
+        case data.NormalizationMode.OFF:
+            return None
+        case data.NormalizationMode.LOUDNORM:
+            return LOUDNORM_FILTER
+        case data.NormalizationMode.ALBUM if song.album_gain is not None:
+            return gain_filter(replay_gain(song.album_gain, song.album_peak))
+
+    # Prefer the server's ReplayGain data, as it's free
+    if song.track_gain is not None:
+        return gain_filter(replay_gain(song.track_gain, song.track_peak))
+
+    if loudness_store is None:
+        return LOUDNORM_FILTER
+
+    # Otherwise, normalize songs with a fixed gain once their loudness is known
+    return loudness_store.normalization_filter(song.song_id)
+
+
+def get_normalization_gain(song: Song, normalization_mode: "data.NormalizationMode") -> float:
+    ''' Returns the gain (in dB) used to normalize a song's loudness in the PCM gain stage.\n
+        Unlike with ffmpeg filters there's no real-time loudnorm, as the gain stage's limiter already keeps unmeasured songs from clipping.
+    '''
+
+    if normalization_mode is data.NormalizationMode.OFF:
+        return 0.0
+
+    # Loudnorm mode prefers songs' own measurements
+    if normalization_mode is data.NormalizationMode.LOUDNORM and loudness_store is not None:
+        gain = loudness_store.gain(song.song_id)
+        if gain is not None:
+            return gain
+
+    if normalization_mode is data.NormalizationMode.ALBUM and song.album_gain is not None:
+        return replay_gain(song.album_gain, song.album_peak)
+
+    if song.track_gain is not None:
+        return replay_gain(song.track_gain, song.track_peak)
+
+    if loudness_store is None:
+        return 0.0
+
+    gain = loudness_store.gain(song.song_id)
+    return gain if gain is not None else 0.0
+
+
+def analyze_loudness(song: Song, normalization_mode: "data.NormalizationMode", owner_id: any) -> None:
+    ''' Measures a song's loudness in the background for its next plays, if it's normalized without the server's ReplayGain data '''
+
+    if loudness_store is None or song.track_gain is not None:
+        return
+
+    # Without the gain stage, loudnorm mode always normalizes in real time
+    if normalization_mode is data.NormalizationMode.OFF or (normalization_mode is data.NormalizationMode.LOUDNORM and not gain_stage_enabled):
+        return
+
+    loudness_store.analyze(song.song_id, backend.stream(song.song_id), owner_id)
+
+
+def _read_ahead(source: discord.AudioSource, owner_id: any) -> discord.AudioSource:
+    ''' Wraps an audio source in the read-ahead buffer, if it's enabled '''
+
+    if env.READ_AHEAD_BUFFER <= 0:
+        return source
+
+    return ReadAheadAudio(source, int(env.READ_AHEAD_BUFFER / 0.02), owner_id)
+
+
+def read_ahead(source: discord.AudioSource, owner_id: any) -> discord.AudioSource:
+    ''' Wraps an audio source that's about to play in the read-ahead buffer, if it's enabled.\n
+        PCM sources are returned unchanged, as they're already buffered beneath their gain stage (see `create_pcm_source`).
+    '''
+
+    if not source.is_opus():
+        return source
+
+    return _read_ahead(source, owner_id)
+
+
+def get_stream_bitrate(channel: discord.abc.Connectable, quality_tier: "data.QualityTier") -> int:
+    ''' Returns the bitrate (in kbps) to stream at in a voice channel, for the given quality tier '''
+
+    channel_bitrate = channel.bitrate // 1000 if channel is not None else _DEFAULT_BITRATE
+
+    match quality_tier:
+        case data.QualityTier.LOW:
+            bitrate = 64
+        case data.QualityTier.MEDIUM:
+            bitrate = 96
+        case data.QualityTier.HIGH:
+            bitrate = 128
+        case _:
+            bitrate = channel_bitrate
+
+    # Anything above the channel's bitrate is wasted, as that's what Discord delivers to listeners
+    return max(_MIN_BITRATE, min(bitrate, channel_bitrate, _MAX_BITRATE))
+
+
+def get_encoder_complexity(bitrate: int) -> int:
+    ''' Returns the Opus encoder complexity (0-10) to use at the given bitrate (in kbps) '''
+
+    # Higher bitrates sound transparent even with a cheaper encoder, so only low bitrates get the full complexity
+    if bitrate >= 128:
+        return 5
+    if bitrate >= 96:
+        return 7
+    return 10
+
+
+def get_input_options(offset: int) -> str:
+    ''' Returns the ffmpeg input options for a stream from the Subsonic server, seeking to the given offset (in seconds) if there is one.\n
+        Seeking the input makes ffmpeg request the file from that point on, rather than downloading and decoding everything before it.
+    '''
+
+    if offset > 0:
+        return f"{_STREAM_INPUT_OPTIONS} -ss {offset}"
+
+    return _STREAM_INPUT_OPTIONS
+
+
+def get_elapsed_step(duration: int, interval: float) -> int:
+    ''' Returns how coarsely (in seconds) the elapsed time of a playing song is displayed on the now-playing message.\n
+        The step is no finer than the refresh interval, and no finer than half a segment of the progress bar, so the
+        displayed time doesn't force an edit more often than the bar itself moves on long songs.
+    '''
+
+    target = max(interval, duration / ui.BAR_LENGTH / 2)
+    return next((step for step in _ELAPSED_STEPS if step >= target), _ELAPSED_STEPS[-1])
+
+
+async def create_stream_source(song: Song, normalization_mode: "data.NormalizationMode", bitrate: int, owner_id: any, offset: int=0,
+                               is_owned: Callable[[], bool]=None) -> discord.AudioSource:
+    ''' Creates an audio source streaming a song from the Subsonic server (or from the audio cache, when possible) at the given bitrate (in kbps),
+        starting at the given offset (in seconds).\n
+        The owner (a guild id, or any other key) is used to share transcodes fairly, and to identify the stream in logs.
+        The stream's process is killed by the watchdog if `is_owned` keeps returning False.
+    '''
+
+    normalization_filter = get_normalization_filter(song, normalization_mode)
+    encoder_options = f"-compression_level {get_encoder_complexity(bitrate)}"
+    ffmpeg_options = {"before_options": _STREAM_INPUT_OPTIONS,
+                      "options": f"-filter:a {normalization_filter} {encoder_options}" if normalization_filter is not None else encoder_options,
+                      "bitrate": bitrate}
+
+    # If the audio doesn't need filtering, let the server transcode it to Opus so it only has to be remuxed here
+    transcoded = normalization_filter is None and await backend.supports_opus_transcoding(song)
+    if transcoded:
+        ffmpeg_options["codec"] = "copy"
+        ffmpeg_options["options"] = ""
+
+    # Songs are cached per set of options, as they change the encoded audio (and only when played from the start)
+    cache_key = None
+    if audio_cache is not None and offset == 0:
+        cache_key = audio_cache.key(song.song_id, json.dumps({key: value for key, value in ffmpeg_options.items() if key != "before_options"}, sort_keys=True))
+        cached_path = audio_cache.lookup(cache_key)
+
+        if cached_path is not None:
+            return CachedOpusAudio(cached_path)
+
+    # Encoding is limited by the transcode scheduler (remuxing is cheap enough not to be)
+    slot = None
+    if not transcoded:
+        slot = await transcode_scheduler.acquire(owner_id)
+
+        # If the host is too busy, fall back to the cheapest stream possible (which isn't worth caching)
+        if slot is None:
+            logger.info("%s: Too many concurrent transcodes, degrading the stream of song '%s'.", owner_id, song.song_id)
+            ffmpeg_options["options"] = "-compression_level 0"
+            cache_key = None
+
+            transcoded = await backend.supports_opus_transcoding(song)
+            if transcoded:
+                ffmpeg_options["codec"] = "copy"
+                ffmpeg_options["options"] = ""
+            else:
+                ffmpeg_options["bitrate"] = min(bitrate, env.TRANSCODE_DEGRADED_BITRATE)
+
+    # Ask the server not to send more than will be streamed; transcodes can start at the offset on the server's side,
+    # while original files are seeked by ffmpeg
+    if transcoded:
+        source = backend.stream(song.song_id, format=env.SUBSONIC_TRANSCODE_FORMAT, max_bitrate=min(bitrate, env.SUBSONIC_TRANSCODE_BITRATE),
+                                time_offset=offset if offset > 0 else None)
+    else:
+        source = backend.stream(song.song_id)
+        ffmpeg_options["before_options"] = get_input_options(offset)
+
+    try:
+        # Store the stream in the audio cache while it's played for the first time
+        if cache_key is not None:
+            audio_src = CachingFFmpegOpusAudio(source, audio_cache, cache_key, song.duration, **ffmpeg_options)
+        else:
+            audio_src = discord.FFmpegOpusAudio(source, **ffmpeg_options)
+    except Exception:
+        if slot is not None:
+            slot.release()
+        raise
+
+    transcode_scheduler.apply_process_policy(audio_src)
+    audio_src = process_watchdog.watch(audio_src, owner_id, is_owned)
+    return ScheduledAudio(audio_src, slot) if slot is not None else audio_src
+
+
+async def create_pcm_source(song: Song, normalization_mode: "data.NormalizationMode", volume: Callable[[], float], owner_id: any, offset: int=0,
+                            is_owned: Callable[[], bool]=None) -> discord.AudioSource:
+    ''' Creates an audio source decoding a song to PCM from the given offset (in seconds), with normalization and the (live) volume applied by the gain stage.\n
+        The audio is encoded by the voice client, so it can't be cached or transcoded by the server.
+    '''
+
+    gain = get_normalization_gain(song, normalization_mode)
+
+    # Decoding and encoding are still limited by the transcode scheduler, but there's no cheaper stream to fall back to
+    slot = await transcode_scheduler.acquire(owner_id)
+    if slot is None:
+        logger.info("%s: Too many concurrent transcodes, streaming song '%s' anyway.", owner_id, song.song_id)
+
+    try:
+        audio_src = discord.FFmpegPCMAudio(backend.stream(song.song_id), before_options=get_input_options(offset))
+    except Exception:
+        if slot is not None:
+            slot.release()
+        raise
+
+    transcode_scheduler.apply_process_policy(audio_src)
+    audio_src = process_watchdog.watch(audio_src, owner_id, is_owned)
+
+    # Buffer the decoded audio beneath the gain stage, so volume changes still reach the voice client instantly
+    audio_src = GainStage(_read_ahead(audio_src, owner_id), gain, volume)
+    return ScheduledAudio(audio_src, slot) if slot is not None else audio_src
+
+
+
 class Player():
     ''' Class that represents an audio player '''
 
     def __init__(self, guild_id: int) -> None:
-        self._data = _default_data
+        self._data = copy.deepcopy(_default_data)
         self._data["guild-id"] = guild_id
+        self._data["now-playing-lock"] = asyncio.Lock()
 
 
     @property
@@ -128,14 +403,9 @@ class Player():
 
 
     @property
-    def now_playing_update_task(self) -> asyncio.Task:
-        ''' An update task that updates the now-playing message on an interval. '''
-        return self._data["now-playing-update-task"]
-    
-
-    @now_playing_update_task.setter
-    def now_playing_update_task(self, task: asyncio.Task) -> None:
-        self._data["now-playing-update-task"] = task
+    def now_playing_lock(self) -> asyncio.Lock:
+        ''' A lock held while the now-playing message is being sent or edited, so there's never more than one edit in flight. '''
+        return self._data["now-playing-lock"]
 
 
     @property
@@ -160,6 +430,39 @@ class Player():
         self._data["now-playing-last-song"] = song
 
 
+    @property
+    def now_playing_cover_id(self) -> str:
+        ''' The id of the cover displayed by the now-playing message. '''
+        return self._data["now-playing-cover-id"]
+
+
+    @now_playing_cover_id.setter
+    def now_playing_cover_id(self, cover_id: str) -> None:
+        self._data["now-playing-cover-id"] = cover_id
+
+
+    @property
+    def now_playing_thumbnail(self) -> str:
+        ''' The thumbnail URL used by the now-playing message (either its own attachment, or a previously uploaded cover). '''
+        return self._data["now-playing-thumbnail"]
+
+
+    @now_playing_thumbnail.setter
+    def now_playing_thumbnail(self, url: str) -> None:
+        self._data["now-playing-thumbnail"] = url
+
+
+    @property
+    def now_playing_fingerprint(self) -> tuple:
+        ''' The visible state of the now-playing message, as of its last update. '''
+        return self._data["now-playing-fingerprint"]
+
+
+    @now_playing_fingerprint.setter
+    def now_playing_fingerprint(self, fingerprint: tuple) -> None:
+        self._data["now-playing-fingerprint"] = fingerprint
+
+
     @property
     def autoplay_source(self) -> list[Song]:
         ''' The current autoplay source. '''
@@ -171,9 +474,73 @@ class Player():
         self._data["autoplay-source"] = value
 
 
+    @property
+    def cover_prefetch_tasks(self) -> set[asyncio.Task]:
+        ''' Background tasks fetching the covers of queued songs. '''
+        return self._data["cover-prefetch-tasks"]
+
+
+
+    @property
+    def prewarm_task(self) -> asyncio.Task:
+        ''' A task that prepares the next track's audio source shortly before the current track ends. '''
+        return self._data["prewarm-task"]
+
+
+    @prewarm_task.setter
+    def prewarm_task(self, task: asyncio.Task) -> None:
+        self._data["prewarm-task"] = task
+
+
+    @property
+    def prewarmed_song(self) -> Song:
+        ''' The song whose audio source has been prepared ahead of time. '''
+        return self._data["prewarmed-song"]
+
+
+    @prewarmed_song.setter
+    def prewarmed_song(self, song: Song) -> None:
+        self._data["prewarmed-song"] = song
+
+
+    @property
+    def prewarmed_source(self) -> PrewarmedAudio:
+        ''' The audio source prepared ahead of time for the next song. '''
+        return self._data["prewarmed-source"]
+
+
+    @prewarmed_source.setter
+    def prewarmed_source(self, source: PrewarmedAudio) -> None:
+        self._data["prewarmed-source"] = source
+
+
+    @property
+    def station(self) -> any:
+        ''' The station this guild is listening to, if any (in which case the queue isn't played). '''
+        return self._data["station"]
+
+
+    @station.setter
+    def station(self, station: any) -> None:
+        self._data["station"] = station
+
+
+    @property
+    def interrupted_song(self) -> Song:
+        ''' A song whose playback was cut off by a lost voice connection, to be resumed at `last_elapsed` once reconnected. '''
+        return self._data["interrupted-song"]
+
+
+    @interrupted_song.setter
+    def interrupted_song(self, song: Song) -> None:
+        self._data["interrupted-song"] = song
+
+
 
-    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient) -> None:
-        ''' Streams a track from the Subsonic server to a connected voice channel, and updates guild data accordingly '''
+    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient, offset: int=0) -> None:
+        ''' Streams a track from the Subsonic server to a connected voice channel (starting at the given offset, in seconds),
+            and updates guild data accordingly
+        '''
 
         # Make sure the voice client is available
         if voice_client is None:
@@ -185,16 +552,17 @@ class Player():
             await ui.ErrMsg.already_playing(interaction)
             return
 
-        # Get the stream from the Subsonic server, using the provided song's ID
-        ffmpeg_options = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                           "options": "-filter:a loudnorm=I=-14:LRA=11:TP=-1.5"}
-        audio_src = discord.FFmpegOpusAudio(backend.stream(song.song_id), **ffmpeg_options)
-        # audio_src.read()
+        # Use the audio source prepared ahead of time for this song if there is one, otherwise start streaming it now
+        audio_src = self.take_prewarmed_source(song) if offset == 0 else None
+        if audio_src is None:
+            audio_src = await self.create_stream_source(song, voice_client, offset)
+
+        audio_src = read_ahead(audio_src, self.guild_id)
 
         # Update the currently playing song's data
         self.current_song = song
         self.last_start_time = int(time.time())
-        self.last_elapsed = 0
+        self.last_elapsed = offset
         self.paused = False
 
         # Set up a callback to set up the next track after a song finishes playing
@@ -204,8 +572,16 @@ class Player():
             if error is not None:
                 logger.error("Exception occurred during playback: %s", error)
 
-            # Don't remove anything else from the queue if we're not connected to a voice channel
+            # If the connection was lost mid-song, remember where it stopped so it can resume from there once reconnected
             if not voice_client.is_connected():
+                if self.current_song is song and self.station is None and self.elapsed < song.duration:
+                    self.last_elapsed = self.elapsed
+                    self.paused = True
+                    self.interrupted_song = song
+                return
+
+            # Don't remove anything else from the queue if a station took over
+            if self.station is not None:
                 return
 
             asyncio.run_coroutine_threadsafe(self.handle_autoplay(interaction, self.current_song.song_id), loop)
@@ -223,9 +599,158 @@ class Player():
 
         # Begin playing the song and let the user know it's being played
         try:
-            voice_client.play(audio_src, after=playback_finished)
+            voice_client.play(audio_src, after=playback_finished, bitrate=self.stream_bitrate(voice_client))
         except (discord.ClientException):
-            pass
+            audio_src.cleanup()
+            return
+
+        # Measure the song's loudness if it's unknown, so its next plays can be normalized with a fixed gain
+        analyze_loudness(song, data.guild_properties(self.guild_id).normalization_mode, self.guild_id)
+
+        # Prepare the next track shortly before this one ends
+        self.schedule_prewarm(interaction, song)
+
+
+    async def create_stream_source(self, song: Song, voice_client: discord.VoiceClient, offset: int=0) -> discord.AudioSource:
+        ''' Creates an audio source streaming a song from the given offset (in seconds), normalized according to the guild's normalization mode
+            (and volume, with the gain stage), and encoded for the voice channel according to the guild's quality tier
+        '''
+
+        properties = data.guild_properties(self.guild_id)
+
+        # Streams belong to the guild's voice connection (whichever it currently is)
+        guild = voice_client.guild if voice_client is not None else None
+
+        def is_owned() -> bool:
+            return guild is not None and guild.voice_client is not None and guild.voice_client.is_connected()
+
+        # With the gain stage, the voice client does the encoding
+        if gain_stage_enabled:
+            return await create_pcm_source(song, properties.normalization_mode, lambda: properties.volume, self.guild_id, offset, is_owned)
+
+        return await create_stream_source(song, properties.normalization_mode, self.stream_bitrate(voice_client), self.guild_id, offset, is_owned)
+
+
+    def stream_bitrate(self, voice_client: discord.VoiceClient) -> int:
+        ''' Returns the bitrate (in kbps) to stream at in the given voice client's channel '''
+
+        channel = voice_client.channel if voice_client is not None else None
+        return get_stream_bitrate(channel, data.guild_properties(self.guild_id).quality_tier)
+
+
+    async def seek(self, interaction: discord.Interaction, voice_client: discord.VoiceClient, position: int) -> None:
+        ''' Restarts the current song's stream at the given position (in seconds), without interrupting playback '''
+
+        song = self.current_song
+        audio_src = read_ahead(await self.create_stream_source(song, voice_client, position), self.guild_id)
+
+        # Playback may have moved on while the stream was starting
+        if self.current_song is not song or not (voice_client.is_playing() or voice_client.is_paused()):
+            audio_src.cleanup()
+            return
+
+        # Swapping the source resumes the voice client, so pause it again if needed
+        paused = voice_client.is_paused()
+        voice_client.source = SeekedAudio(audio_src, voice_client.source)
+        if paused:
+            voice_client.pause()
+
+        # Update the elapsed time to match
+        self.last_start_time = int(time.time())
+        self.last_elapsed = position
+
+        # The next track now needs preparing at a different time
+        self.schedule_prewarm(interaction, song)
+
+
+    def schedule_prewarm(self, interaction: discord.Interaction, song: Song) -> None:
+        ''' Schedules the next track's audio source to be started shortly before the given (currently playing) song ends '''
+
+        if self.prewarm_task is not None:
+            self.prewarm_task.cancel()
+            self.prewarm_task = None
+
+        if env.PREWARM_LEAD <= 0 or song.duration <= 0:
+            return
+
+        async def prewarm() -> None:
+            await asyncio.sleep(max(0, song.duration - self.elapsed - env.PREWARM_LEAD))
+
+            # Wait until the song is actually near its end, in case it was paused in the meantime
+            while self.current_song is song and (self.paused or song.duration - self.elapsed > env.PREWARM_LEAD):
+                await asyncio.sleep(1)
+
+            if self.current_song is not song:
+                return
+
+            # Make sure autoplay has picked the next song, then prepare it
+            await self.handle_autoplay(interaction, song.song_id)
+            if self.queue == []:
+                return
+
+            next_song = self.queue[0]
+            if self.prewarmed_song is next_song:
+                return
+
+            self.discard_prewarmed_source()
+            source = await self.create_stream_source(next_song, interaction.guild.voice_client)
+
+            # The queue may have changed while the source was being created
+            if self.current_song is not song or self.queue == [] or self.queue[0] is not next_song:
+                source.cleanup()
+                return
+
+            self.prewarmed_song = next_song
+            self.prewarmed_source = PrewarmedAudio(source, int(env.PREWARM_BUFFER / 0.02))
+
+
+        async def run_prewarm() -> None:
+            try:
+                await prewarm()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("%s: Failed to prepare the next track: %s", self.guild_id, err)
+            finally:
+                if self.prewarm_task is asyncio.current_task():
+                    self.prewarm_task = None
+
+        self.prewarm_task = asyncio.create_task(run_prewarm(), name="prewarm_task")
+
+
+    def take_prewarmed_source(self, song: Song) -> discord.AudioSource:
+        ''' Returns the audio source prepared ahead of time for the given song, or None if there isn't one.\n
+            Sources prepared for any other song are discarded.
+        '''
+
+        if self.prewarmed_source is not None and self.prewarmed_song is song:
+            source = self.prewarmed_source
+            self.prewarmed_song = None
+            self.prewarmed_source = None
+            return source
+
+        self.discard_prewarmed_source()
+        return None
+
+
+    def discard_prewarmed_source(self) -> None:
+        ''' Stops the audio source prepared ahead of time, if there is one. '''
+
+        if self.prewarmed_source is not None:
+            self.prewarmed_source.cleanup()
+
+        self.prewarmed_song = None
+        self.prewarmed_source = None
+
+
+    def cancel_prewarm(self) -> None:
+        ''' Stops preparing the next track, and discards it if it's already prepared. '''
+
+        if self.prewarm_task is not None:
+            self.prewarm_task.cancel()
+            self.prewarm_task = None
+
+        self.discard_prewarmed_source()
 
 
     async def handle_autoplay(self, interaction: discord.Interaction, prev_song_id: str=None):
@@ -248,16 +773,16 @@ class Player():
 
         match autoplay_mode:
             case data.AutoplayMode.RANDOM:
-                songs = backend.get_random_songs(size=1)
+                songs = await backend.get_random_songs(size=1)
                 songs[0].username = "Autoplay (Random)"
             case data.AutoplayMode.SIMILAR:
-                songs = backend.get_similar_songs(song_id=prev_song_id, count=1)
+                songs = await backend.get_similar_songs(song_id=prev_song_id, count=1)
                 songs[0].username = "Autoplay (Similar)"
             case data.AutoplayMode.PLAYLIST:
 
                 # If the autoplay playlist source has been exhausted, fill it again
                 if player.autoplay_source is None or cast(Playlist, player.autoplay_source).songs == []:
-                    player.autoplay_source = backend.get_playlist(source_id)
+                    player.autoplay_source = await backend.get_playlist(source_id)
 
                 # Remove a random song from the playlist source and queue it up
                 autoplay_source = cast(Playlist, player.autoplay_source)
@@ -273,7 +798,7 @@ class Player():
         self.queue.append(songs[0])
 
         # Fetch the cover art in advance
-        backend.get_album_art_file(songs[0].cover_id, interaction.guild_id)
+        self.prefetch_covers(songs)
 
 
     async def play_audio_queue(self, interaction: discord.Interaction, voice_client: discord.VoiceClient) -> None:
@@ -284,8 +809,16 @@ class Player():
             await ui.ErrMsg.bot_not_in_voice_channel(interaction)
             return
         
-        # Check if the bot is already playing something
-        if voice_client.is_playing():
+        # Check if the bot is already playing something (which includes listening to a station)
+        if voice_client.is_playing() or self.station is not None:
+            return
+
+        # Resume a song that was cut off by a lost connection where it left off
+        if self.interrupted_song is not None:
+            song = self.interrupted_song
+            self.interrupted_song = None
+
+            await self.stream_track(interaction, song, voice_client, self.last_elapsed)
             return
 
         await self.handle_autoplay(interaction)
@@ -312,9 +845,47 @@ class Player():
         self.current_song = None
 
 
+    def prefetch_covers(self, songs: list[Song]) -> None:
+        ''' Fetches the covers of the given songs in the background, with limited concurrency. '''
+
+        cover_ids = list(dict.fromkeys(song.cover_id for song in songs if song.cover_id != ""))
+        if len(cover_ids) == 0:
+            return
+
+        semaphore = asyncio.Semaphore(env.COVER_PREFETCH_CONCURRENCY)
+
+        async def prefetch_cover(cover_id: str) -> None:
+            async with semaphore:
+                try:
+                    await backend.get_album_art_file(cover_id, background=True)
+                except Exception as err:
+                    logger.debug("%s: Failed to prefetch cover '%s': %s", self.guild_id, cover_id, err)
+
+        async def prefetch() -> None:
+            await asyncio.gather(*(prefetch_cover(cover_id) for cover_id in cover_ids))
+
+        task = asyncio.create_task(prefetch(), name="cover_prefetch_task")
+        self.cover_prefetch_tasks.add(task)
+        task.add_done_callback(self.cover_prefetch_tasks.discard)
+
+
+    def cancel_cover_prefetch(self) -> None:
+        ''' Cancels any covers still waiting to be prefetched. '''
+
+        for task in self.cover_prefetch_tasks:
+            task.cancel()
+
+        self.cover_prefetch_tasks.clear()
+
+
     async def skip_track(self, voice_client: discord.VoiceClient) -> None:
         ''' Skip the current track. '''
 
+        # Stations skip the current song for every listener
+        if self.station is not None:
+            self.station.skip()
+            return
+
         # Stop the current song
         voice_client.stop()
 
@@ -329,16 +900,24 @@ class Player():
         if interaction is not None:
             await ui.SysMsg.disconnected(interaction)
 
+        # Stop listening to the station, if there is one
+        if self.station is not None:
+            self.station.unsubscribe(self.guild_id)
+            self.station = None
+
+        # Clear the current song first, so it isn't considered interrupted by the disconnection
+        self.current_song = None
+        self.interrupted_song = None
+
         await voice_client.disconnect()
 
         # Clean up misc. state
-        self.current_song = None
         self.paused = False
+        self.cancel_cover_prefetch()
+        self.cancel_prewarm()
 
-        # Clean up the now-playing update coroutine
-        if (self.now_playing_update_task is not None):
-            self.now_playing_update_task.cancel()
-            self.now_playing_update_task = None
+        # Stop updating the now-playing message
+        if now_playing_scheduler.unschedule(self.guild_id):
             await self.delete_now_playing()
 
 
@@ -348,6 +927,37 @@ class Player():
             in order to determine which channel the now-playing view should be sent in.
         '''
 
+        # Wait for any update that's already in flight, so they don't race each other
+        async with self.now_playing_lock:
+            await self._update_now_playing(interaction, force_create)
+
+
+    async def refresh_now_playing(self) -> bool:
+        ''' Refreshes the now-playing message, as scheduled. Returns whether it should keep being refreshed. '''
+
+        if self.current_song is None:
+            return False
+
+        # Nothing moves while paused, and there's no point queueing behind an update that's already in flight
+        if self.paused or self.now_playing_lock.locked():
+            return True
+
+        try:
+            await self.update_now_playing()
+        except discord.HTTPException as err:
+            if err.status == 429:
+                raise
+
+            # The authorization token expires after a while; so create a new message
+            await self.delete_now_playing()
+            await self.update_now_playing(force_create=True)
+
+        return True
+
+
+    async def _update_now_playing(self, interaction: discord.Interaction, force_create: bool) -> None:
+        ''' Updates or creates the now-playing message; see `update_now_playing` '''
+
         if (self.now_playing_message is None and self.now_playing_channel is None and interaction is None):
             logger.error("There is no message to update, and there is not enough context to create one.")
             return
@@ -368,77 +978,118 @@ class Player():
         if self.now_playing_channel is None and self.now_playing_message is not None:
             self.now_playing_channel = self.now_playing_message.channel
 
+        # Work out what the message would display; while playing, the elapsed time is rounded so it doesn't change on every refresh
+        song = self.current_song
+        elapsed = self.elapsed
+        if not self.paused:
+            elapsed -= elapsed % get_elapsed_step(song.duration, now_playing_scheduler.interval)
+
+        bar = ui.parse_elapsed_as_bar(elapsed, song.duration)
+        elapsed_printable = f"{(elapsed // 60):02d}:{(elapsed % 60):02d}"
+        fingerprint = (song.song_id, song.title, bar, elapsed_printable, self.paused, song.username)
+
+        # Determine whether we're responding to an interaction, sending a new message, or editing the existing one
+        responding = interaction is not None and not force_create
+        sending = not responding and (force_create or self.now_playing_message is None)
+
+        # Whether the existing message (and the cover attached to it) is about to be deleted in favour of another message
+        replacing = sending or (responding and (self.now_playing_message is None
+                                                or interaction.message is None
+                                                or self.now_playing_message.id != interaction.message.id))
+
+        # Reuse the CDN URL of an already-uploaded cover if there's a valid one (that won't be deleted along with this message)
+        excluded_message_id = self.now_playing_message.id if replacing and self.now_playing_message is not None else None
+        cover_url = ui.get_cover_url(song.cover_id, excluded_message_id)
+
+        updating_cover = (replacing
+                          or self.now_playing_cover_id != song.cover_id
+                          or (self.now_playing_thumbnail != "attachment://image.png" and cover_url is None))
+
+        # Skip edits that wouldn't visibly change anything
+        if not responding and not sending and not updating_cover and fingerprint == self.now_playing_fingerprint:
+            metrics.increment("now-playing-edits-skipped")
+            now_playing_scheduler.schedule(self.guild_id, self.refresh_now_playing)
+            return
+
         view = await self.create_now_playing_view()
 
         # Set up the now-playing embed
-        song = self.current_song
-        cover_art = backend.get_album_art_file(song.cover_id, self.guild_id)
         desc = ( f"**{song.title}** - *{song.artist}*"
         f"\n{song.album}"
-        f"\n\n{ui.parse_elapsed_as_bar(self.elapsed, song.duration)}"
+        f"\n\n{bar}"
         )
 
         embed = discord.Embed(color=discord.Color.orange(), title="Now Playing", description=desc)
-        embed.set_thumbnail(url="attachment://image.png")
         embed.set_footer(text=(
-            f"{self.elapsed_printable} / {song.duration_printable}"
+            f"{elapsed_printable} / {song.duration_printable}"
             f" - added by {song.username}"
         ))
 
         # Set up message args (avoid re-sending data, like attachments)
         kwargs = {"embed": embed, "view": view}
-        if (force_create):
-            kwargs["file"] = ui.get_thumbnail(cover_art)
-        elif (interaction is not None 
-                or self.now_playing_last_song is None 
-                or self.current_song.song_id != self.now_playing_last_song.song_id):
-            kwargs["attachments"] = [ui.get_thumbnail(cover_art)]
+        uploading_cover = False
+
+        if updating_cover:
+
+            if cover_url is not None:
+                self.now_playing_thumbnail = cover_url
+
+                # Drop the previous cover's attachment, as it's no longer displayed
+                if not replacing:
+                    kwargs["attachments"] = []
+            else:
+                self.now_playing_thumbnail = "attachment://image.png"
+                uploading_cover = True
+
+                if sending:
+                    kwargs["file"] = await ui.get_cover_thumbnail(song.cover_id)
+                else:
+                    kwargs["attachments"] = [await ui.get_cover_thumbnail(song.cover_id)]
+
+        embed.set_thumbnail(url=self.now_playing_thumbnail)
+
+        # Attachments replaced by an edit are deleted, so their URLs can't be reused anymore
+        if not replacing and "attachments" in kwargs:
+            ui.forget_cover_urls(self.now_playing_message.id)
 
         # If an interaction was passed, assume that we want to respond to it and make it the new message to update
-        if interaction is not None and not force_create:
+        if responding:
 
             # Defer the interaction if it hasn't been deferred yet, and delete the last message
             if not interaction.response.is_done():
                 await interaction.response.defer(thinking=False)
 
             # Avoid deleting a message that we're responding to
-            if interaction.message is None or self.now_playing_message.id != interaction.message.id:
+            if replacing:
                 await self.delete_now_playing()
 
             # Update the now-playing message
+            edit_started = time.monotonic()
             self.now_playing_message = await interaction.edit_original_response(**kwargs)
 
         # We can force create a message as long as we have the channel to create it in
-        elif force_create or self.now_playing_message is None:
+        elif sending:
             await self.delete_now_playing()
+            edit_started = time.monotonic()
             self.now_playing_message = await self.now_playing_channel.send(**kwargs)
 
         else: # Otherwise, just edit the existing message
-            await self.now_playing_message.edit(**kwargs)
+            edit_started = time.monotonic()
+            self.now_playing_message = await self.now_playing_message.edit(**kwargs)
 
+        # Back the refresh interval off if the edit waited on a rate limit (uploading a cover is expected to be slower)
+        if not uploading_cover and time.monotonic() - edit_started > _SLOW_NOW_PLAYING_EDIT:
+            now_playing_scheduler.note_rate_limited()
 
-        # Start a task to update the now-playing message on a time interval
-        async def update_loop() -> None:
-            while self.current_song is not None:
-                try:
-                    await asyncio.sleep(6)
-                    if not self.paused:
-                        await self.update_now_playing()
-
-                except discord.HTTPException as e:
-                    # The authorization token expires after a while; so create a new message
-                    await self.delete_now_playing()
-                    await self.update_now_playing(force_create=True)
-
-                except Exception as e:
-                    logger.warning(f"{self.guild_id}: Ignoring exception in the now-playing update task: {e}")
-
-            self.now_playing_update_task = None
-            return
+        # Remember where the cover was uploaded to, so later messages can link to it instead
+        if uploading_cover:
+            ui.remember_cover_url(song.cover_id, self.now_playing_message)
 
+        self.now_playing_cover_id = song.cover_id
+        self.now_playing_fingerprint = fingerprint
 
-        if self.now_playing_update_task is None:
-            self.now_playing_update_task = asyncio.create_task(update_loop(), name="now_playing_update_task")
+        # Keep the now-playing message updated on an interval
+        now_playing_scheduler.schedule(self.guild_id, self.refresh_now_playing)
 
         # Successful update: track the last song we updated information for
         self.now_playing_last_song = song
@@ -527,7 +1178,10 @@ class Player():
         if (self.now_playing_message is not None):
             try:
                 await self.now_playing_message.delete()
+                ui.forget_cover_urls(self.now_playing_message.id)
                 self.now_playing_message = None
+                self.now_playing_cover_id = None
+                self.now_playing_fingerprint = None
             except discord.HTTPException:
                 pass
 
@@ -0,0 +1,30 @@
+''' Benchmarks the cost of the PCM gain stage. Run with `python -m scripts.benchmark_gain` from the repository's root. '''
+
+import discord
+import time
+
+from audio.gain import apply_gain, numpy
+
+
+def benchmark(frames: int=50 * 60) -> None:
+    ''' Prints the time taken to process a frame of loud noise (which keeps the limiter busy) '''
+
+    rng = numpy.random.default_rng(0)
+    noise = [rng.integers(-32768, 32767, discord.opus.Encoder.SAMPLES_PER_FRAME * discord.opus.Encoder.CHANNELS, dtype=numpy.int16).tobytes()
+             for _ in range(50)]
+
+    limiter_gain = 1.0
+    start = time.perf_counter()
+    for i in range(frames):
+        _, limiter_gain = apply_gain(noise[i % len(noise)], 1.5, limiter_gain)
+    elapsed = time.perf_counter() - start
+
+    per_frame = elapsed / frames
+    print(f"{frames} frames in {elapsed:.3f}s: {per_frame * 1e6:.1f}µs per frame, {per_frame / 0.02:.2%} of a core per stream")
+
+
+if __name__ == "__main__":
+    if numpy is None:
+        raise SystemExit("NumPy is required to benchmark the gain stage.")
+
+    benchmark()
@@ -0,0 +1,202 @@
+''' Stations: shared listening sessions, where a playlist is played once and broadcast to every listening guild '''
+
+import asyncio
+import discord
+import logging
+import random
+import time
+
+import data
+import player
+
+from audio.broadcast import BroadcastStream
+from subsonic.playlist import Playlist
+from subsonic.song import Song
+import subsonic.backend as backend
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+# Songs that end sooner than this (in seconds) without being skipped are considered to have failed to stream
+_MIN_SONG_LENGTH = 1
+
+# The number of songs in a row that may fail to stream before the station stops
+_MAX_FAILURES = 5
+
+
+class Station():
+    ''' Shuffles through a playlist, streaming each song once and broadcasting it to the voice clients of every listening guild '''
+
+    def __init__(self, playlist_id: str) -> None:
+        self.playlist_id = playlist_id
+        self.current_song: Song = None
+        self.start_time = 0
+
+        self._listeners: dict[int, discord.VoiceClient] = {} # guild id -> voice client
+        self._remaining: Playlist = None
+        self._stream = BroadcastStream(int(env.STATION_LEAD / 0.02), int(env.STATION_BUFFER / 0.02))
+        self._task: asyncio.Task = None
+        self._skipped = False
+
+
+    @property
+    def listeners(self) -> list[int]:
+        ''' The ids of the guilds listening to the station. '''
+        return list(self._listeners)
+
+
+    def subscribe(self, guild_id: int, voice_client: discord.VoiceClient) -> None:
+        ''' Starts playing the station in a guild's voice channel '''
+
+        def listener_finished(error: Exception) -> None:
+            if error is not None:
+                logger.error("%s: Exception occurred while listening to station '%s': %s", guild_id, self.playlist_id, error)
+
+        voice_client.play(self._stream.listen(), after=listener_finished)
+        self._listeners[guild_id] = voice_client
+        self._sync_player(guild_id)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"station_task_{self.playlist_id}")
+
+
+    def unsubscribe(self, guild_id: int) -> None:
+        ''' Stops playing the station in a guild, and closes the station once nobody is listening '''
+
+        voice_client = self._listeners.pop(guild_id, None)
+        if voice_client is not None:
+            voice_client.stop()
+
+        if len(self._listeners) == 0:
+            self.close()
+
+
+    def skip(self) -> None:
+        ''' Skips the current song for every listener '''
+
+        self._skipped = True
+        self._stream.stop_source()
+
+
+    def close(self) -> None:
+        ''' Stops the station, ending playback for any remaining listeners '''
+
+        for guild_id in self._listeners:
+            guild_player = data.guild_data(guild_id).player
+            guild_player.station = None
+            guild_player.current_song = None
+
+        self._listeners.clear()
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        self._stream.close()
+        _stations.pop(self.playlist_id, None)
+
+
+    async def _next_song(self) -> Song:
+        ''' Picks a random song that hasn't been played since the playlist was last exhausted '''
+
+        if self._remaining is None or self._remaining.songs == []:
+            self._remaining = await backend.get_playlist(self.playlist_id)
+
+            if self._remaining is None or self._remaining.songs == []:
+                return None
+
+        song = self._remaining.songs.pop(random.randrange(len(self._remaining.songs)))
+        song.username = f"Station ({self._remaining.name})"
+        return song
+
+
+    async def _run(self) -> None:
+        ''' Plays songs until the station is closed '''
+
+        failures = 0
+
+        try:
+            while len(self._listeners) > 0:
+                song = await self._next_song()
+                if song is None:
+                    logger.error("Station '%s' has no songs to play.", self.playlist_id)
+                    break
+
+                owner_id = f"station:{self.playlist_id}"
+                source = await player.create_stream_source(song, data.NormalizationMode.TRACK, self._bitrate(), owner_id,
+                                                           is_owned=lambda: not self._stream.closed)
+                source = player.read_ahead(source, owner_id)
+                player.analyze_loudness(song, data.NormalizationMode.TRACK, owner_id)
+
+                self.current_song = song
+                self.start_time = int(time.time())
+
+                try:
+                    await self._update_listeners()
+                except asyncio.CancelledError:
+                    source.cleanup()
+                    raise
+
+                self._skipped = False
+                play_time = time.monotonic()
+                await self._stream.play(source)
+
+                # Stop instead of spinning through the playlist if songs keep failing to stream
+                if not self._skipped and time.monotonic() - play_time < _MIN_SONG_LENGTH:
+                    failures += 1
+                    if failures >= _MAX_FAILURES:
+                        logger.error("Station '%s' stopped after %s songs in a row failed to stream.", self.playlist_id, failures)
+                        break
+                else:
+                    failures = 0
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error("Station '%s' stopped due to an exception.", self.playlist_id, exc_info=err)
+
+        self._task = None
+        self.close()
+
+
+    def _bitrate(self) -> int:
+        ''' Returns the bitrate (in kbps) to stream at, which is that of the best voice channel listening '''
+        return max(player.get_stream_bitrate(voice_client.channel, data.QualityTier.AUTO) for voice_client in self._listeners.values())
+
+
+    def _sync_player(self, guild_id: int) -> None:
+        ''' Updates a listening guild's player with the station's current song '''
+
+        guild_player = data.guild_data(guild_id).player
+        guild_player.station = self
+        guild_player.current_song = self.current_song
+        guild_player.last_start_time = self.start_time
+        guild_player.last_elapsed = 0
+        guild_player.paused = False
+
+
+    async def _update_listeners(self) -> None:
+        ''' Updates each listening guild's player (and its own now-playing message) with the current song '''
+
+        for guild_id in self.listeners:
+            self._sync_player(guild_id)
+
+            try:
+                await data.guild_data(guild_id).player.update_now_playing()
+            except Exception as err:
+                logger.warning("%s: Failed to update the now-playing message for station '%s': %s", guild_id, self.playlist_id, err)
+
+
+
+_stations: dict[str, Station] = {} # playlist id -> station
+
+
+def get_station(playlist_id: str) -> Station:
+    ''' Returns the station playing the given playlist, creating it if necessary '''
+
+    if playlist_id not in _stations:
+        _stations[playlist_id] = Station(playlist_id)
+
+    return _stations[playlist_id]
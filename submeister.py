@@ -10,7 +10,14 @@ import sys
 
 from discord.ext import commands
 
+import asyncio
 import data
+import subsonic.backend as backend
+
+from audio.loudness import loudness_store
+from audio.watchdog import process_watchdog
+from subsonic.covers import cover_store
+from subsonic.library import library_index
 
 from util import env
 from util import logs
@@ -20,10 +27,16 @@ class SubmeisterClient(commands.Bot):
     ''' An instance of the submeister client '''
 
     test_guild: int
+    cover_eviction_task: asyncio.Task
+    library_sync_task: asyncio.Task
+    process_watchdog_task: asyncio.Task
 
 
     def __init__(self, test_guild: int=None) -> None:
         self.test_guild = test_guild
+        self.cover_eviction_task = None
+        self.library_sync_task = None
+        self.process_watchdog_task = None
 
         super().__init__(command_prefix=commands.when_mentioned, intents=discord.Intents.all())
 
@@ -65,6 +78,17 @@ class SubmeisterClient(commands.Bot):
         if self.test_guild:
             await self.sync_command_tree()
 
+        # Keep the cover art cache within its budget
+        self.cover_eviction_task = asyncio.create_task(cover_store.run_eviction(env.COVER_CACHE_EVICTION_INTERVAL), name="cover_eviction_task")
+
+        # Keep the local library index up to date, if it's enabled
+        if library_index is not None:
+            self.library_sync_task = asyncio.create_task(backend.run_library_sync(), name="library_sync_task")
+
+        # Clean up ffmpeg processes left behind by a crash, and supervise the ones spawned from now on
+        process_watchdog.sweep_orphans()
+        self.process_watchdog_task = asyncio.create_task(process_watchdog.run(env.FFMPEG_WATCHDOG_INTERVAL), name="process_watchdog_task")
+
 
     async def on_ready(self) -> None:
         ''' Event called when the client is done preparing. '''
@@ -72,6 +96,28 @@ class SubmeisterClient(commands.Bot):
         logger.info("Logged as: %s | Connected Guilds: %s | Loaded Extensions: %s", self.user, len(self.guilds), list(self.extensions))
 
 
+    async def close(self) -> None:
+        ''' Closes the client, along with any open connections to the Subsonic server. '''
+
+        if self.cover_eviction_task is not None:
+            self.cover_eviction_task.cancel()
+            cover_store.save_index()
+
+        if self.library_sync_task is not None:
+            self.library_sync_task.cancel()
+            library_index.close()
+
+        if loudness_store is not None:
+            loudness_store.close()
+
+        if self.process_watchdog_task is not None:
+            self.process_watchdog_task.cancel()
+            process_watchdog.kill_all()
+
+        await backend.close_session()
+        await super().close()
+
+
 if __name__ == "__main__":
     logs.setup_logging()
     logger = logging.getLogger(__name__)
@@ -1,39 +1,170 @@
 ''' For interfacing with the Subsonic API '''
 
+import aiohttp
+import asyncio
+import hashlib
+import json
 import logging
-import os
-import requests
+import secrets
+import time
 
-from typing import Tuple
+from typing import Awaitable, Callable, Tuple
 from pathlib import Path
+from urllib.parse import urlencode
 from subsonic.song import Song
 from subsonic.playlist import Playlist
+from subsonic import covers
+from subsonic import library
+from subsonic.suggestions import song_suggestions
 
 from util import env
+from util.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
-# Parameters for the Subsonic API
+# Parameters for the Subsonic API (authentication parameters are added by `request_params()`)
 SUBSONIC_REQUEST_PARAMS = {
         "u": env.SUBSONIC_USER,
-        "p": env.SUBSONIC_PASSWORD,
         "v": "1.15.0",
         "c": "submeister",
         "f": "json"
     }
 
 
-def check_subsonic_error(response: requests.Response) -> bool:
-    ''' Checks and logs error codes returned by the subsonic API. Returns True if an error is present. '''
+# Cached salted token used for authentication, along with the time it was generated
+_auth_params: dict[str, str] = {}
+_auth_generated_time: float = 0
+
+
+def get_auth_params() -> dict[str, str]:
+    ''' Returns the authentication parameters for the Subsonic API.\n
+        The salted token is computed once and reused until the rotation interval has passed.
+    '''
+
+    global _auth_params, _auth_generated_time
+
+    # Plain password authentication (for servers/users that don't support token authentication)
+    if env.SUBSONIC_LEGACY_AUTH:
+        return {"p": env.SUBSONIC_PASSWORD}
+
+    if _auth_params == {} or time.monotonic() - _auth_generated_time >= env.SUBSONIC_TOKEN_ROTATION:
+        salt = secrets.token_hex(8)
+        token = hashlib.md5((env.SUBSONIC_PASSWORD + salt).encode("utf-8")).hexdigest()
+
+        _auth_params = {"t": token, "s": salt}
+        _auth_generated_time = time.monotonic()
+
+    return _auth_params
+
+
+def request_params(params: dict=None) -> dict[str, str]:
+    ''' Returns the full set of parameters for a Subsonic API request, including authentication. '''
+
+    return SUBSONIC_REQUEST_PARAMS | get_auth_params() | (params or {})
+
+
+# Shared HTTP session (keeps connections to the Subsonic server alive between requests)
+_session: aiohttp.ClientSession = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    ''' Returns the shared HTTP session used for Subsonic requests, creating it if necessary.\n
+        Must be called from within the running event loop.
+    '''
+
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=env.SUBSONIC_MAX_CONNECTIONS,
+                                         limit_per_host=env.SUBSONIC_MAX_CONNECTIONS_PER_HOST,
+                                         keepalive_timeout=env.SUBSONIC_KEEPALIVE_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=env.SUBSONIC_TIMEOUT, connect=env.SUBSONIC_CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+
+async def close_session() -> None:
+    ''' Closes the shared HTTP session, if one is open. '''
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+
+
+# Cache for responses from read-only endpoints
+response_cache = TTLCache(env.SUBSONIC_CACHE_SIZE, env.SUBSONIC_CACHE_TTL)
+
+
+def _cache_key(endpoint: str, params: dict) -> tuple:
+    ''' Creates a cache key from an endpoint and its (normalized) parameters '''
+
+    normalized = []
+    for key, value in params.items():
+        value = str(value)
+
+        # Searches are case-insensitive, so queries differing only by case or whitespace can share a cache entry
+        if key == "query":
+            value = " ".join(value.lower().split())
+
+        normalized.append((key, value))
+
+    return (endpoint, tuple(sorted(normalized)))
+
+
+def _is_ok_response(json_data: dict) -> bool:
+    ''' Returns True if the given response was successful (and may be cached) '''
 
     try:
-        json = response.json()
-    except requests.exceptions.JSONDecodeError:
+        return json_data["subsonic-response"]["status"] == "ok"
+    except KeyError:
         return False
 
+
+def invalidate_cache(endpoint: str=None) -> int:
+    ''' Invalidates cached responses (for a single endpoint, if specified). Returns the number of entries removed. '''
+
+    if endpoint is None:
+        return response_cache.invalidate()
+
+    return response_cache.invalidate(lambda key: key[0] == endpoint)
+
+
+async def _get_json(endpoint: str, params: dict, *, cached: bool=False) -> dict:
+    ''' Sends a GET request to the given Subsonic endpoint and returns the decoded JSON response.\n
+        Cached responses are shared between callers, and must not be modified.
+    '''
+
+    async def fetch() -> dict:
+        session = get_session()
+        async with session.get(f"{env.SUBSONIC_SERVER}/rest/{endpoint}", params=request_params(params)) as response:
+            try:
+                return await response.json(content_type=None)
+            except json.JSONDecodeError:
+                return {}
+
+    if not cached:
+        return await fetch()
+
+    return await response_cache.get_or_fetch(_cache_key(endpoint, params), fetch, cache_if=_is_ok_response)
+
+
+def _parse_song(json_object: dict) -> Song:
+    ''' Creates a song from its JSON object, remembering it so it can be suggested later '''
+
+    song_suggestions.add(json_object)
+    return Song(json_object)
+
+
+def check_subsonic_error(json_data: dict) -> bool:
+    ''' Checks and logs error codes returned by the subsonic API. Returns True if an error is present. '''
+
     try:
-        err_code: int = json["subsonic-response"]["error"]["code"]
+        err_code: int = json_data["subsonic-response"]["error"]["code"]
     except KeyError:
         return False
 
@@ -63,9 +194,22 @@ def check_subsonic_error(response: requests.Response) -> bool:
     return True
 
 
-def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_count: int=20, album_offset: int=0, song_count: int=20, song_offset: int=0) -> list[Song]:
+async def run_library_sync() -> None:
+    ''' Keeps the local library index in sync with the server. Runs until cancelled. '''
+
+    await library.library_index.run_sync(_get_json, env.LIBRARY_SYNC_INTERVAL)
+
+
+async def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_count: int=20, album_offset: int=0, song_count: int=20, song_offset: int=0) -> list[Song]:
     ''' Send a search request to the subsonic API '''
 
+    # Answer from the local library index if possible, only asking the server on a miss. Past the first page, an empty page
+    # means the index's results ran out, as the server ranks and matches songs differently
+    if library.library_index is not None and library.library_index.ready and song_count > 0:
+        items = await library.library_index.search_songs(query, song_count, song_offset)
+        if len(items) > 0 or song_offset > 0:
+            return [_parse_song(item) for item in items]
+
     # Sanitize special characters in the user's query
     #parsed_query = urlParse.quote(query, safe='')
 
@@ -79,49 +223,138 @@ def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_coun
         "songOffset": str(song_offset)
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | search_params
-
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/search3.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _get_json("search3.view", search_params, cached=True)
 
     results: list[Song] = []
 
     try:
         for item in search_data["subsonic-response"]["searchResult3"]["song"]:
-            results.append(Song(item))
+            results.append(_parse_song(item))
     except KeyError:
         return []
 
     return results
 
 
-def get_album_art_file(cover_id: str, guild_id: int, size: int=300) -> str:
-    ''' Request album art from the subsonic API '''
-    target_path = f"cache/{guild_id}/{cover_id}.jpg"
+# Tracks cover art requests that someone is waiting on, so background requests can give them priority
+_interactive_cover_requests = 0
+_interactive_cover_keys: dict[str, int] = {} # cover key -> interactive requests for it
+_cover_turn = asyncio.Event() # Replaced every time it's set
 
-    # Check if the cover art is already cached (TODO: Check for last-modified date?)
-    if os.path.exists(target_path):
-        return target_path
 
-    cover_params = {
-        "id": cover_id,
-        "size": str(size)
-    }
+def _notify_cover_turn() -> None:
+    ''' Wakes background cover requests up, to check whether it's their turn '''
+
+    global _cover_turn
+    _cover_turn.set()
+    _cover_turn = asyncio.Event()
+
+
+async def get_album_art_file(cover_id: str, size: int=300, *, original: bool=False, background: bool=False) -> str:
+    ''' Request album art from the subsonic API (or the shared cover art cache).\n
+        Returns a downscaled thumbnail of the cover, unless the original is requested.
+        Background requests (i.e. prefetching) are only sent while no other cover requests are in progress,
+        unless someone starts waiting on the same cover, which promotes the background request.
+    '''
+
+    original_key = f"{cover_id}:{size}"
+    thumbnail_key = f"{cover_id}:{size}:thumbnail"
+
+    async def fetch_original() -> bytes:
+        global _interactive_cover_requests
+
+        cover_params = {
+            "id": cover_id,
+            "size": str(size)
+        }
+
+        if background:
+            while _interactive_cover_requests > 0 and original_key not in _interactive_cover_keys:
+                await _cover_turn.wait()
+
+        # Promoted background requests get the same priority as interactive ones
+        interactive = not background or original_key in _interactive_cover_keys
+        if interactive:
+            _interactive_cover_requests += 1
+
+        try:
+            session = get_session()
+            async with session.get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=request_params(cover_params)) as response:
+                content = await response.read()
+
+                # Errors are returned as JSON instead of image data
+                if response.content_type == "application/json":
+                    check_subsonic_error(json.loads(content))
+                    return None
+
+                if response.status != 200:
+                    logger.warning("Cover art request for '%s' failed with HTTP status %s.", cover_id, response.status)
+                    return None
+
+                return content
+        finally:
+            if interactive:
+                _interactive_cover_requests -= 1
+                if _interactive_cover_requests == 0:
+                    _notify_cover_turn()
+
+    if original:
+        return await _get_cover(original_key, fetch_original, background)
+
+    async def fetch_thumbnail() -> bytes:
+
+        # Reuse the original if it's been kept, otherwise fetch it (and only keep it if configured to)
+        original_path = covers.cover_store.lookup(original_key)
+        if original_path is not None:
+            content = await asyncio.to_thread(Path(original_path).read_bytes)
+        else:
+            content = await fetch_original()
+            if content is None:
+                return None
+
+            if env.COVER_KEEP_ORIGINAL:
+                await covers.cover_store.store(original_key, content)
+
+        return await covers.make_thumbnail(content)
 
-    params = SUBSONIC_REQUEST_PARAMS | cover_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=params, timeout=20)
+    return await _get_cover(thumbnail_key, fetch_thumbnail, background, original_key)
 
-    # Grab cover art for the current song
-    if check_subsonic_error(response):
-        return "resources/cover_not_found.jpg"
 
-    file = Path(target_path)
-    file.parent.mkdir(exist_ok=True, parents=True)
-    file.write_bytes(response.content)
-    return target_path
+async def _get_cover(key: str, fetch: Callable[[], Awaitable[bytes]], background: bool, original_key: str=None) -> str:
+    ''' Gets a cover from the shared cover art cache, marking interactive requests so that a background fetch
+        of the same (original) cover they end up waiting on is promoted
+    '''
 
+    if background:
+        return await covers.cover_store.get(key, fetch)
 
-def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_year: int=None, music_folder_id: str=None) -> list[Song]:
+    original_key = original_key or key
+    _interactive_cover_keys[original_key] = _interactive_cover_keys.get(original_key, 0) + 1
+    _notify_cover_turn()
+
+    try:
+        return await covers.cover_store.get(key, fetch)
+    finally:
+        _interactive_cover_keys[original_key] -= 1
+        if _interactive_cover_keys[original_key] == 0:
+            del _interactive_cover_keys[original_key]
+
+
+async def get_song(song_id: str) -> Song:
+    ''' Obtains a specific song (or None if it wasn't found) '''
+
+    song_data = await _get_json("getSong", {"id": song_id}, cached=True)
+
+    if check_subsonic_error(song_data):
+        return None
+
+    try:
+        return _parse_song(song_data["subsonic-response"]["song"])
+    except KeyError:
+        return None
+
+
+async def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_year: int=None, music_folder_id: str=None) -> list[Song]:
     ''' Request random songs from the subsonic API '''
 
     search_params: dict[str, any] = {}
@@ -142,18 +375,16 @@ def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_ye
     if music_folder_id is not None:
         search_params["musicFolderId"] = music_folder_id
 
-    params = SUBSONIC_REQUEST_PARAMS | search_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getRandomSongs.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _get_json("getRandomSongs.view", search_params)
 
     results: list[Song] = []
     for item in search_data["subsonic-response"]["randomSongs"]["song"]:
-        results.append(Song(item))
+        results.append(_parse_song(item))
 
     return results
 
 
-def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
+async def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
     ''' Request similar songs from the Subsonic API '''
 
     search_params = {
@@ -161,22 +392,19 @@ def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
         "count": count
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | search_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getSimilarSongs2.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _get_json("getSimilarSongs2.view", search_params, cached=True)
 
     results: list[Song] = []
     for item in search_data["subsonic-response"]["similarSongs2"]["song"]:
-        results.append(Song(item))
+        results.append(_parse_song(item))
 
     return results
 
 
-def get_playlists() -> list[Playlist]:
+async def get_playlists() -> list[Playlist]:
     ''' Obtains a list of playlists '''
 
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getPlaylists", params=SUBSONIC_REQUEST_PARAMS, timeout=20)
-    playlist_data = response.json()
+    playlist_data = await _get_json("getPlaylists", {}, cached=True)
 
     results: list[Playlist] = []
     for item in playlist_data["subsonic-response"]["playlists"]["playlist"]:
@@ -185,53 +413,111 @@ def get_playlists() -> list[Playlist]:
     return results
 
 
-def get_playlist(playlist_id: str) -> Playlist:
+async def get_playlist(playlist_id: str) -> Playlist:
     ''' Obtains a specific playlist, along with its songs '''
 
     playlist_params = {
         "id": playlist_id
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | playlist_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getPlaylist", params=params, timeout=20)
-    playlist_data = response.json()
+    playlist_data = await _get_json("getPlaylist", playlist_params, cached=True)
 
     playlist = Playlist(playlist_data["subsonic-response"]["playlist"])
 
     songs: list[Song] = []
     for item in playlist_data["subsonic-response"]["playlist"]["entry"]:
-        playlist.songs.append(Song(item))
+        playlist.songs.append(_parse_song(item))
         
     return playlist
 
 
-def get_songs_in_playlist(playlist_id: str) -> list[Song]:
+async def get_songs_in_playlist(playlist_id: str) -> list[Song]:
     ''' Obtains a list of the songs in a given playlist  '''
 
     playlist_params = {
         "id": playlist_id
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | playlist_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getPlaylist", params=params, timeout=20)
-    playlist_data = response.json()
+    playlist_data = await _get_json("getPlaylist", playlist_params, cached=True)
 
     songs: list[Song] = []
     for item in playlist_data["subsonic-response"]["playlist"]["entry"]:
-        songs.append(Song(item))
+        songs.append(_parse_song(item))
         
     return songs
 
 
-def stream(stream_id: str) -> str:
-    ''' Send a stream request to the subsonic API '''
+def stream(stream_id: str, *, format: str=None, max_bitrate: int=None, time_offset: int=None) -> str:
+    ''' Builds a stream URL for the given song.\n
+        The original file is streamed, unless a format (and optionally a maximum bitrate) to transcode to is provided.
+        Transcoded streams may also start at a time offset (in seconds).
+        No request is sent; the URL is opened directly by the audio player.
+    '''
 
-    stream_params = {
-        "id": stream_id,
-        "raw": "true"
-    }
+    stream_params = {"id": stream_id}
 
-    params = SUBSONIC_REQUEST_PARAMS | stream_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/stream.view", params=params, timeout=20, stream=True)
+    if format is None:
+        stream_params["raw"] = "true"
+    else:
+        stream_params["format"] = format
+
+    if max_bitrate is not None:
+        stream_params["maxBitRate"] = str(max_bitrate)
+
+    if time_offset is not None:
+        stream_params["timeOffset"] = str(time_offset)
+
+    return f"{env.SUBSONIC_SERVER}/rest/stream.view?{urlencode(request_params(stream_params))}"
+
+
+# Whether the server transcodes streams to Opus when asked to (None until checked)
+_opus_transcoding: bool = None
+
+# Content types of Opus streams
+_OPUS_CONTENT_TYPES = ("audio/ogg", "audio/opus", "application/ogg")
+
+# Extensions of files that may already be Ogg/Opus, which servers can send as they are (so streams of them look transcoded either way)
+_OGG_SUFFIXES = ("ogg", "oga", "opus")
+
+
+async def supports_opus_transcoding(song: Song) -> bool:
+    ''' Checks whether the server can transcode streams to Opus, by requesting one for the given song and inspecting its content type
+        and first bytes.\n
+        The check is only done once, with a song that isn't already in an Ogg container; servers without a transcoder send the original file instead.
+        Until it's been done, songs that can't be checked are assumed not to be transcoded.
+    '''
+
+    global _opus_transcoding
+
+    if not env.SUBSONIC_TRANSCODE:
+        return False
 
-    return response.url
+    if _opus_transcoding is None:
+        if song.suffix.lower() in _OGG_SUFFIXES or song.suffix == "":
+            return False
+
+        stream_params = {
+            "id": song.song_id,
+            "format": env.SUBSONIC_TRANSCODE_FORMAT,
+            "maxBitRate": str(env.SUBSONIC_TRANSCODE_BITRATE)
+        }
+
+        try:
+            session = get_session()
+            async with session.get(f"{env.SUBSONIC_SERVER}/rest/stream.view", params=request_params(stream_params)) as response:
+                try:
+                    head = await response.content.readexactly(64)
+                except asyncio.IncompleteReadError as err:
+                    head = err.partial
+
+                # An Ogg stream whose first page holds the Opus header
+                _opus_transcoding = (response.status == 200 and response.content_type in _OPUS_CONTENT_TYPES
+                                     and head.startswith(b"OggS") and b"OpusHead" in head)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logger.warning("Failed to check whether the server supports Opus transcoding: %s", err)
+            return False
+
+        if not _opus_transcoding:
+            logger.info("The server doesn't transcode to Opus (content type: '%s'), streams will be transcoded locally instead.", response.content_type)
+
+    return _opus_transcoding
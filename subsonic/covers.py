@@ -0,0 +1,281 @@
+''' A cover art cache shared by all guilds '''
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+# Pillow is optional; without it covers are stored exactly as the server returns them
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+COVER_NOT_FOUND_PATH = "resources/cover_not_found.jpg"
+
+
+class CoverStore():
+    ''' Stores cover art on disk, keyed by cover id and deduplicated by the hash of its contents.\n
+        The store is kept within a byte budget by evicting the least recently used (or oldest) covers.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float, negative_ttl: float) -> None:
+        self._directory = Path(directory)
+        self._index_path = self._directory / "index.json"
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._negative_ttl = negative_ttl
+
+        self._covers: dict[str, str] = {}          # cover key -> content hash
+        self._sizes: dict[str, int] = {}           # content hash -> size in bytes
+        self._accessed: dict[str, float] = {}      # content hash -> last access time
+        self._not_found: dict[str, float] = {}     # cover key -> time the negative entry expires
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._waiters: dict[str, int] = {}         # cover key -> requests waiting on its in-flight fetch
+
+        self._load_index()
+
+
+    @property
+    def total_bytes(self) -> int:
+        ''' The total size of all stored covers, in bytes. '''
+        return sum(self._sizes.values())
+
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the contents of the store. '''
+        return {
+            "covers": len(self._covers),
+            "files": len(self._sizes),
+            "bytes": self.total_bytes,
+            "not-found": len(self._not_found)
+        }
+
+
+    def _blob_path(self, content_hash: str) -> Path:
+        ''' Returns the path a cover with the given content hash is stored at '''
+        return self._directory / f"{content_hash}.jpg"
+
+
+    def _load_index(self) -> None:
+        ''' Loads the cover index from disk, discarding entries whose files no longer exist '''
+
+        if not self._index_path.exists():
+            return
+
+        try:
+            index = json.loads(self._index_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as err:
+            logger.warning("Failed to load the cover art index, starting with an empty cache: %s", err)
+            return
+
+        for content_hash, accessed in index.get("accessed", {}).items():
+            try:
+                self._sizes[content_hash] = self._blob_path(content_hash).stat().st_size
+                self._accessed[content_hash] = accessed
+            except OSError:
+                continue
+
+        self._covers = {key: content_hash for key, content_hash in index.get("covers", {}).items() if content_hash in self._sizes}
+
+
+    def _serialize_index(self) -> bytes:
+        ''' Serializes the cover index so it can be written to disk '''
+
+        return json.dumps({"covers": self._covers, "accessed": self._accessed}).encode("utf-8")
+
+
+    def save_index(self) -> None:
+        ''' Writes the cover index to disk '''
+
+        self._write_atomic(self._index_path, self._serialize_index())
+
+
+    def _write_atomic(self, path: Path, content: bytes) -> None:
+        ''' Writes a file by renaming a fully written temporary file into place, so readers never see partial data '''
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except OSError:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+
+
+    def lookup(self, key: str) -> str:
+        ''' Returns the path of a cached cover, or None if it isn't cached '''
+
+        content_hash = self._covers.get(key)
+        if content_hash is None:
+            return None
+
+        self._accessed[content_hash] = time.time()
+        return str(self._blob_path(content_hash))
+
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> str:
+        ''' Returns the path of a cover, fetching and storing it if necessary.\n
+            `fetch` should return the cover's contents, or None if the server responded with an error.
+        '''
+
+        path = self.lookup(key)
+        if path is not None:
+            return path
+
+        # Don't repeatedly ask the server for covers it recently failed to provide
+        expiry = self._not_found.get(key)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return COVER_NOT_FOUND_PATH
+            del self._not_found[key]
+
+        # Share a single fetch between concurrent requests for the same cover
+        if key not in self._in_flight:
+            self._in_flight[key] = asyncio.ensure_future(self._fetch_and_store(key, fetch))
+            self._in_flight[key].add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        future = self._in_flight[key]
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The fetch is shielded from any single request, but cancelled once every request waiting on it is
+            if self._waiters[key] == 1 and not future.done():
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+
+
+    async def _fetch_and_store(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> str:
+        ''' Fetches a cover and stores it '''
+
+        content = await fetch()
+
+        if content is None:
+            self._not_found[key] = time.monotonic() + self._negative_ttl
+            return COVER_NOT_FOUND_PATH
+
+        return await self.store(key, content)
+
+
+    async def store(self, key: str, content: bytes) -> str:
+        ''' Stores a cover under its content hash, and returns its path '''
+
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        # Only write the file if no other cover shares the same contents
+        if content_hash not in self._sizes:
+            await asyncio.to_thread(self._write_atomic, self._blob_path(content_hash), content)
+            self._sizes[content_hash] = len(content)
+
+        self._covers[key] = content_hash
+        self._accessed[content_hash] = time.time()
+        return str(self._blob_path(content_hash))
+
+
+    def evict(self) -> int:
+        ''' Removes expired covers, then the least recently used ones until the store fits its budget.\n
+            Returns the number of files removed.
+        '''
+
+        now = time.time()
+        total_bytes = self.total_bytes
+        removed: set[str] = set()
+
+        # Oldest first
+        for content_hash, accessed in sorted(self._accessed.items(), key=lambda item: item[1]):
+            if now - accessed < self._max_age and total_bytes <= self._max_bytes:
+                break
+
+            self._blob_path(content_hash).unlink(missing_ok=True)
+            total_bytes -= self._sizes.pop(content_hash, 0)
+            del self._accessed[content_hash]
+            removed.add(content_hash)
+
+        # Forget every cover key referring to a removed file
+        if len(removed) > 0:
+            self._covers = {key: content_hash for key, content_hash in self._covers.items() if content_hash not in removed}
+
+        # Expired negative entries
+        now = time.monotonic()
+        self._not_found = {key: expiry for key, expiry in self._not_found.items() if expiry > now}
+
+        return len(removed)
+
+
+    async def run_eviction(self, interval: float) -> None:
+        ''' Periodically evicts covers and saves the index. Runs until cancelled. '''
+
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                removed = self.evict()
+                await asyncio.to_thread(self._write_atomic, self._index_path, self._serialize_index())
+
+                if removed > 0:
+                    logger.info("Evicted %s cover(s) from the cover art cache (%s bytes remaining).", removed, self.total_bytes)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("Ignoring exception in the cover art eviction task: %s", err)
+
+
+
+# Worker threads used to create thumbnails, so image processing doesn't block the event loop
+_thumbnail_executor = ThreadPoolExecutor(max_workers=env.THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+
+
+def _make_thumbnail(content: bytes, size: int, quality: int) -> bytes:
+    ''' Downscales an image to fit within a square of the given size, and re-encodes it as a JPEG.\n
+        Returns the original content if it can't be processed, or if it is already smaller.
+    '''
+
+    if Image is None:
+        return content
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as err:
+        logger.warning("Failed to create a thumbnail, using the original cover instead: %s", err)
+        return content
+
+    thumbnail = output.getvalue()
+    return thumbnail if len(thumbnail) < len(content) else content
+
+
+async def make_thumbnail(content: bytes) -> bytes:
+    ''' Creates a small, well-compressed thumbnail of a cover in a worker thread '''
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_thumbnail_executor, _make_thumbnail, content, env.THUMBNAIL_SIZE, env.THUMBNAIL_QUALITY)
+
+
+
+cover_store = CoverStore(env.COVER_CACHE_DIR, env.COVER_CACHE_MAX_BYTES, env.COVER_CACHE_MAX_AGE, env.COVER_CACHE_NEGATIVE_TTL)
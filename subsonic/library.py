@@ -0,0 +1,264 @@
+''' A local index of the Subsonic library, allowing searches to be answered without contacting the server '''
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS artists (id TEXT PRIMARY KEY, name TEXT, json TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS albums (id TEXT PRIMARY KEY, name TEXT, artist TEXT, signature TEXT, json TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS songs (id TEXT PRIMARY KEY, album_id TEXT, json TEXT NOT NULL);
+    DROP TABLE IF EXISTS playlists; -- Indexed by earlier versions, but never used
+    CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+    CREATE INDEX IF NOT EXISTS songs_album_id ON songs (album_id);
+    CREATE VIRTUAL TABLE IF NOT EXISTS song_search USING fts5(song_id UNINDEXED, title, artist, album, tokenize='unicode61 remove_diacritics 2');
+"""
+
+# The number of albums requested per page while crawling the library
+_ALBUM_PAGE_SIZE = 500
+
+
+def _album_signature(album: dict) -> str:
+    ''' Summarizes the fields of an album listing that change when its contents change '''
+    return json.dumps([album.get(key) for key in ("name", "artist", "songCount", "duration", "created", "changed", "coverArt")])
+
+
+def _parse_query(query: str) -> str:
+    ''' Converts a user's search query into an FTS query matching every word as a prefix (or None if there are no words) '''
+
+    words = re.findall(r"\w+", query)
+    if len(words) == 0:
+        return None
+
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class LibraryIndex():
+    ''' Songs, albums and artists from the Subsonic server, stored in an SQLite database with full-text search '''
+
+    def __init__(self, path: str) -> None:
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+
+        # The connection is shared by worker threads, so access to it is serialized
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+
+        self._ready = self._get_state("complete") == "1"
+
+
+    @property
+    def ready(self) -> bool:
+        ''' Whether the library has been fully crawled at least once. '''
+        return self._ready
+
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' The number of items of each type in the index. '''
+
+        with self._lock:
+            return {table: self._connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    for table in ("artists", "albums", "songs")}
+
+
+    def close(self) -> None:
+        ''' Closes the database connection. '''
+
+        with self._lock:
+            self._connection.close()
+
+
+    def _get_state(self, key: str) -> str:
+        ''' Returns a value describing the state of the last sync '''
+
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+
+    def _set_state(self, key: str, value: str) -> None:
+        ''' Stores a value describing the state of the last sync '''
+
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+    def _search_songs(self, query: str, count: int, offset: int) -> list[dict]:
+        ''' Searches song titles, artists and albums, returning the best matches first '''
+
+        fts_query = _parse_query(query)
+        if fts_query is None:
+            return []
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT songs.json FROM song_search JOIN songs ON songs.id = song_search.song_id"
+                " WHERE song_search MATCH ? ORDER BY song_search.rank LIMIT ? OFFSET ?",
+                (fts_query, count, offset)).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+
+    async def search_songs(self, query: str, count: int=20, offset: int=0) -> list[dict]:
+        ''' Searches the index for songs, returning their JSON objects as provided by the Subsonic API '''
+        return await asyncio.to_thread(self._search_songs, query, count, offset)
+
+
+    def _replace_artists(self, artists: list[dict]) -> None:
+        ''' Replaces every artist in the index '''
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM artists")
+            self._connection.executemany("INSERT OR REPLACE INTO artists (id, name, json) VALUES (?, ?, ?)",
+                                         [(artist["id"], artist.get("name"), json.dumps(artist)) for artist in artists])
+
+
+    def _album_signatures(self) -> dict[str, str]:
+        ''' Returns the signature of every indexed album, by album id '''
+
+        with self._lock:
+            return dict(self._connection.execute("SELECT id, signature FROM albums").fetchall())
+
+
+    def _replace_album(self, album: dict, signature: str) -> None:
+        ''' Stores an album along with its songs, replacing any previously indexed version of it '''
+
+        songs: list[dict] = album.get("song", [])
+        album = {key: value for key, value in album.items() if key != "song"}
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM song_search WHERE song_id IN (SELECT id FROM songs WHERE album_id = ?)", (album["id"],))
+            self._connection.execute("DELETE FROM songs WHERE album_id = ?", (album["id"],))
+
+            self._connection.execute("INSERT OR REPLACE INTO albums (id, name, artist, signature, json) VALUES (?, ?, ?, ?, ?)",
+                                     (album["id"], album.get("name"), album.get("artist"), signature, json.dumps(album)))
+            self._connection.executemany("INSERT OR REPLACE INTO songs (id, album_id, json) VALUES (?, ?, ?)",
+                                         [(song["id"], album["id"], json.dumps(song)) for song in songs])
+            self._connection.executemany("INSERT INTO song_search (song_id, title, artist, album) VALUES (?, ?, ?, ?)",
+                                         [(song["id"], song.get("title", ""), song.get("artist", ""), song.get("album", "")) for song in songs])
+
+
+    def _remove_albums(self, album_ids: list[str]) -> None:
+        ''' Removes albums (and their songs) that no longer exist on the server '''
+
+        with self._lock, self._connection:
+            for album_id in album_ids:
+                self._connection.execute("DELETE FROM song_search WHERE song_id IN (SELECT id FROM songs WHERE album_id = ?)", (album_id,))
+                self._connection.execute("DELETE FROM songs WHERE album_id = ?", (album_id,))
+                self._connection.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+
+
+    async def sync(self, get_json: Callable[[str, dict], Awaitable[dict]]) -> None:
+        ''' Brings the index up to date with the server.\n
+            Only albums whose listings changed since the last sync are fetched again.
+        '''
+
+        # Skip crawling the library if the server reports it hasn't been modified since the last sync
+        last_modified = await asyncio.to_thread(self._get_state, "last-modified")
+        index_params = {"ifModifiedSince": last_modified} if self.ready and last_modified is not None else {}
+        indexes: dict = (await get_json("getIndexes", index_params))["subsonic-response"].get("indexes", {})
+
+        if not self.ready or any(key in indexes for key in ("index", "shortcut", "child")):
+            await self._sync_artists(get_json)
+            await self._sync_albums(get_json)
+
+        if "lastModified" in indexes:
+            await asyncio.to_thread(self._set_state, "last-modified", str(indexes["lastModified"]))
+
+        if not self.ready:
+            await asyncio.to_thread(self._set_state, "complete", "1")
+            self._ready = True
+
+
+    async def _sync_artists(self, get_json: Callable[[str, dict], Awaitable[dict]]) -> None:
+        ''' Replaces the indexed artists with the server's current list '''
+
+        artist_data = await get_json("getArtists", {})
+
+        artists: list[dict] = []
+        for index in artist_data["subsonic-response"]["artists"].get("index", []):
+            artists += index.get("artist", [])
+
+        await asyncio.to_thread(self._replace_artists, artists)
+
+
+    async def _sync_albums(self, get_json: Callable[[str, dict], Awaitable[dict]]) -> None:
+        ''' Fetches the songs of new or changed albums, and removes albums that no longer exist '''
+
+        listed: dict[str, dict] = {}
+        offset = 0
+
+        while True:
+            album_data = await get_json("getAlbumList2", {"type": "alphabeticalByName", "size": _ALBUM_PAGE_SIZE, "offset": offset})
+            albums: list[dict] = album_data["subsonic-response"]["albumList2"].get("album", [])
+
+            for album in albums:
+                listed[album["id"]] = album
+
+            if len(albums) < _ALBUM_PAGE_SIZE:
+                break
+
+            offset += _ALBUM_PAGE_SIZE
+
+        known = await asyncio.to_thread(self._album_signatures)
+        changed = [album for album_id, album in listed.items() if known.get(album_id) != _album_signature(album)]
+        removed = [album_id for album_id in known if album_id not in listed]
+
+        semaphore = asyncio.Semaphore(env.LIBRARY_SYNC_CONCURRENCY)
+
+        async def fetch_album(album: dict) -> None:
+            async with semaphore:
+                full_album = (await get_json("getAlbum", {"id": album["id"]}))["subsonic-response"]["album"]
+                await asyncio.to_thread(self._replace_album, full_album, _album_signature(album))
+
+        await asyncio.gather(*(fetch_album(album) for album in changed))
+        await asyncio.to_thread(self._remove_albums, removed)
+
+        if len(changed) > 0 or len(removed) > 0:
+            logger.info("Library index updated: %s album(s) added or changed, %s removed.", len(changed), len(removed))
+
+
+    async def run_sync(self, get_json: Callable[[str, dict], Awaitable[dict]], interval: float) -> None:
+        ''' Periodically syncs the index with the server. Runs until cancelled. '''
+
+        while True:
+            try:
+                await self.sync(get_json)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("Ignoring exception while syncing the library index: %s", err)
+
+            await asyncio.sleep(interval)
+
+
+
+def _create_library_index() -> LibraryIndex:
+    ''' Creates the library index, if it's enabled and supported by this SQLite build '''
+
+    if not env.LIBRARY_INDEX:
+        return None
+
+    try:
+        return LibraryIndex(env.LIBRARY_INDEX_PATH)
+    except sqlite3.Error as err:
+        logger.error("Failed to open the library index, searches will be sent to the server instead.", exc_info=err)
+        return None
+
+
+library_index = _create_library_index()
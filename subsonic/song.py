@@ -9,6 +9,8 @@ class Song():
         self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
         self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
         self._duration: int = json_object["duration"] if "duration" in json_object else 0
+        self._replay_gain: dict = json_object["replayGain"] if "replayGain" in json_object else {}
+        self._suffix: str = json_object["suffix"] if "suffix" in json_object else ""
         self._username: str = "Unknown"
 
 
@@ -54,6 +56,46 @@ class Song():
         return f"{(self._duration // 60):02d}:{(self._duration % 60):02d}"
     
 
+    @property
+    def suffix(self) -> str:
+        ''' The file extension of the song's original file (e.g. `flac`), if provided by the server '''
+
+        # Songs pickled by older versions don't have a suffix
+        return getattr(self, "_suffix", "")
+
+
+    @property
+    def track_gain(self) -> float:
+        ''' The song's ReplayGain track gain in dB, if provided by the server '''
+        return self._get_replay_gain("trackGain")
+
+
+    @property
+    def track_peak(self) -> float:
+        ''' The song's ReplayGain track peak (as a linear amplitude), if provided by the server '''
+        return self._get_replay_gain("trackPeak")
+
+
+    @property
+    def album_gain(self) -> float:
+        ''' The ReplayGain album gain in dB of the album containing the song, if provided by the server '''
+        return self._get_replay_gain("albumGain")
+
+
+    @property
+    def album_peak(self) -> float:
+        ''' The ReplayGain album peak (as a linear amplitude) of the album containing the song, if provided by the server '''
+        return self._get_replay_gain("albumPeak")
+
+
+    def _get_replay_gain(self, key: str) -> float:
+        ''' Returns a ReplayGain value, or None if it isn't available '''
+
+        # Songs pickled by older versions don't have ReplayGain data
+        value = getattr(self, "_replay_gain", {}).get(key)
+        return float(value) if isinstance(value, (int, float)) else None
+
+
     @property
     def username(self) -> str:
         ''' The user who added/played this song. '''
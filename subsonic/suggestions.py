@@ -0,0 +1,122 @@
+''' A fast, in-memory index of recently seen songs, used to suggest songs while the user is typing '''
+
+import unicodedata
+
+from collections import OrderedDict
+
+from util import env
+
+
+def _normalize(text: str) -> str:
+    ''' Lowercases text and strips accents, so that "Café" matches "cafe" '''
+
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def _trigrams(words: list[str]) -> set[str]:
+    ''' Returns every sequence of three characters found within the given words '''
+    return {word[i:i + 3] for word in words for i in range(len(word) - 2)}
+
+
+class SongSuggestions():
+    ''' A bounded index of songs (by their JSON objects as provided by the Subsonic API), searchable by partial words.\n
+        Candidates are found through a trigram index, then filtered and ranked by how closely they match.
+    '''
+
+    def __init__(self, max_songs: int) -> None:
+        self._songs: OrderedDict[str, tuple[dict, str, str]] = OrderedDict() # song id -> (json, normalized title, normalized text)
+        self._trigrams: dict[str, set[str]] = {}
+        self._max_songs = max_songs
+
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+
+    def get(self, song_id: str) -> dict:
+        ''' Returns the JSON object of an indexed song, or None if it isn't indexed '''
+
+        entry = self._songs.get(song_id)
+        return entry[0] if entry is not None else None
+
+
+    def add(self, song: dict) -> None:
+        ''' Adds (or refreshes) a song in the index, forgetting the least recently seen songs if it's full '''
+
+        song_id = song.get("id")
+        if song_id is None:
+            return
+
+        if song_id in self._songs:
+            self._songs.move_to_end(song_id)
+            return
+
+        title = _normalize(song.get("title", ""))
+        text = " ".join((title, _normalize(song.get("artist", "")), _normalize(song.get("album", ""))))
+
+        self._songs[song_id] = (song, title, text)
+        for trigram in _trigrams(text.split()):
+            self._trigrams.setdefault(trigram, set()).add(song_id)
+
+        while len(self._songs) > self._max_songs:
+            self._remove(next(iter(self._songs)))
+
+
+    def _remove(self, song_id: str) -> None:
+        ''' Removes a song from the index '''
+
+        _, _, text = self._songs.pop(song_id)
+
+        for trigram in _trigrams(text.split()):
+            song_ids = self._trigrams.get(trigram)
+            if song_ids is None:
+                continue
+
+            song_ids.discard(song_id)
+            if len(song_ids) == 0:
+                del self._trigrams[trigram]
+
+
+    def lookup(self, query: str, limit: int) -> list[dict]:
+        ''' Returns up to `limit` songs whose title, artist or album contain every word of the query, best matches first '''
+
+        words = _normalize(query).split()
+        if len(words) == 0:
+            return []
+
+        # Narrow down the candidates using the trigram index (short queries check the most recently seen songs instead)
+        trigrams = sorted((self._trigrams.get(trigram, set()) for trigram in _trigrams(words)), key=len)
+        if len(trigrams) > 0:
+            candidates = set.intersection(*trigrams)
+            max_matches = len(candidates)
+        else:
+            candidates = reversed(self._songs.keys())
+            max_matches = limit * 4
+
+        matches: list[tuple[int, int, dict]] = []
+        joined_query = " ".join(words)
+
+        for song_id in candidates:
+            song, title, text = self._songs[song_id]
+            if not all(word in text for word in words):
+                continue
+
+            # Prefer titles starting with the query, then titles containing it, then everything else
+            if title.startswith(joined_query):
+                rank = 0
+            elif joined_query in title:
+                rank = 1
+            else:
+                rank = 2
+
+            matches.append((rank, len(title), song))
+            if len(matches) >= max_matches:
+                break
+
+        matches.sort(key=lambda match: match[:2])
+        return [song for _, _, song in matches[:limit]]
+
+
+
+song_suggestions = SongSuggestions(env.AUTOCOMPLETE_MAX_SONGS)
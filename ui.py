@@ -4,16 +4,33 @@ import discord
 
 import asyncio
 import data
+import io
 import logging
 import math
+import time
 
+from pathlib import Path
 from typing import Tuple
+from urllib.parse import parse_qs, urlparse
+from subsonic.covers import COVER_NOT_FOUND_PATH
 from subsonic.song import Song
 from subsonic.playlist import Playlist
 import subsonic.backend as backend
 
+from util import env
+from util.cache import TTLCache
+
 logger = logging.getLogger(__name__)
 
+# Encoded cover thumbnails kept in memory, keyed by cover id
+thumbnail_cache = TTLCache(env.THUMBNAIL_CACHE_SIZE, env.THUMBNAIL_CACHE_TTL)
+
+# Discord CDN URLs of covers that have already been uploaded, keyed by cover id: (url, expiry time, id of the message it's attached to)
+_cover_urls: dict[str, tuple[str, float, int]] = {}
+
+# The number of segments in a progress bar
+BAR_LENGTH = 17
+
 
 class SysMsg:
     ''' A class for sending system messages '''
@@ -164,6 +181,64 @@ def get_thumbnail(thumbnail_path: str) -> discord.File:
         else:
             return discord.utils.MISSING
 
+async def get_cover_thumbnail(cover_id: str) -> discord.File:
+    ''' Returns a thumbnail file for the given cover, served from memory when possible. '''
+
+    content = thumbnail_cache.get(cover_id)
+
+    if content is None:
+        cover_path = await backend.get_album_art_file(cover_id)
+        content = await asyncio.to_thread(Path(cover_path).read_bytes)
+
+        # Missing covers are retried once the cover store's negative entry expires, so don't keep the placeholder for longer
+        if cover_path != COVER_NOT_FOUND_PATH:
+            thumbnail_cache.set(cover_id, content)
+
+    return discord.File(io.BytesIO(content), filename="image.png")
+
+def remember_cover_url(cover_id: str, message: discord.Message) -> None:
+    ''' Records the CDN URL of a cover that was uploaded as an attachment of the given message. '''
+
+    if len(message.attachments) == 0:
+        return
+
+    url = message.attachments[0].url
+
+    # Attachment URLs are signed, and expire at the (hexadecimal) timestamp given by the `ex` parameter; otherwise assume a lifetime
+    try:
+        expiry = int(parse_qs(urlparse(url).query)["ex"][0], 16)
+    except (KeyError, ValueError):
+        expiry = time.time() + env.COVER_URL_ASSUMED_LIFETIME
+
+    _cover_urls[cover_id] = (url, expiry, message.id)
+
+def get_cover_url(cover_id: str, excluded_message_id: int=None) -> str:
+    ''' Returns the CDN URL of an already-uploaded cover, or None if there is no valid one.\n
+        URLs attached to the excluded message are ignored (i.e. if that message is about to be deleted).
+    '''
+
+    entry = _cover_urls.get(cover_id)
+    if entry is None:
+        return None
+
+    url, expiry, message_id = entry
+
+    # Leave some leeway, so the URL doesn't expire while it's being displayed
+    if expiry - time.time() < env.COVER_URL_EXPIRY_MARGIN:
+        del _cover_urls[cover_id]
+        return None
+
+    if message_id == excluded_message_id:
+        return None
+
+    return url
+
+def forget_cover_urls(message_id: int) -> None:
+    ''' Forgets the CDN URLs of covers attached to a message, as they stop working once it's deleted. '''
+
+    for cover_id in [cover_id for cover_id, entry in _cover_urls.items() if entry[2] == message_id]:
+        del _cover_urls[cover_id]
+
 def truncate(string: str, length: int):
     ''' Truncates a string to a given length. '''
     if len(string) <= length:
@@ -276,7 +351,6 @@ def parse_queue_as_embed(queue: list[Song], page_num: int, num_per_page: int) ->
 def parse_elapsed_as_bar(elapsed: int, duration: int) -> str:
     ''' Parses track time information into a displayable bar. '''
 
-    LENGTH = 17
-    num_filled = max(int(math.ceil(min(elapsed, duration) / duration * LENGTH)) - 1, 0)
+    num_filled = max(int(math.ceil(min(elapsed, duration) / duration * BAR_LENGTH)) - 1, 0)
 
-    return str("▰" * num_filled + "⚪" + "▱" * (LENGTH - num_filled - 1))
+    return str("▰" * num_filled + "⚪" + "▱" * (BAR_LENGTH - num_filled - 1))
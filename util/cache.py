@@ -0,0 +1,143 @@
+''' A bounded in-memory cache with LRU eviction, expiry, and request coalescing '''
+
+import asyncio
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+# Marks missing entries
+_MISSING = object()
+
+
+class TTLCache():
+    ''' A least-recently-used cache whose entries expire after a set time-to-live.\n
+        Concurrent `get_or_fetch` calls for the same key share a single fetch ("single-flight"), and are counted as coalesced
+        rather than as misses. Fetches that were in flight when the cache was invalidated don't store their (possibly stale) results.
+    '''
+
+    def __init__(self, max_entries: int, ttl: float=None) -> None:
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._generation = 0 # Bumped whenever entries are invalidated
+
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing how effective the cache has been. '''
+        return {
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "in-flight": len(self._in_flight)
+        }
+
+
+    def _lookup(self, key: Hashable) -> Any:
+        ''' Returns the cached value for a key, or `_MISSING` if it is missing or expired, without counting a hit or miss '''
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+
+        expiry, value = entry
+        if expiry is not None and expiry <= time.monotonic():
+            del self._entries[key]
+            return _MISSING
+
+        self._entries.move_to_end(key)
+        return value
+
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        ''' Returns the cached value for a key, or the default if it is missing or expired. '''
+
+        value = self._lookup(key)
+
+        if value is _MISSING:
+            self._misses += 1
+            return default
+
+        self._hits += 1
+        return value
+
+
+    def set(self, key: Hashable, value: Any) -> None:
+        ''' Stores a value, evicting the least recently used entries if the cache is full. '''
+
+        expiry = time.monotonic() + self._ttl if self._ttl is not None else None
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]=None) -> int:
+        ''' Removes all entries (or only those whose key matches the predicate). Returns the number of entries removed.\n
+            Matching fetches that are in flight are no longer joined, and their results aren't stored.
+        '''
+
+        self._generation += 1
+
+        for key in [key for key in self._in_flight if predicate is None or predicate(key)]:
+            del self._in_flight[key]
+
+        if predicate is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            del self._entries[key]
+
+        return len(keys)
+
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], *, cache_if: Callable[[Any], bool]=None) -> Any:
+        ''' Returns the cached value for a key, fetching (and caching) it if necessary.\n
+            If a fetch for the same key is already in progress, its result is awaited instead of starting another.
+        '''
+
+        value = self._lookup(key)
+        if value is not _MISSING:
+            self._hits += 1
+            return value
+
+        # Join an identical in-flight request, if there is one
+        if key in self._in_flight:
+            self._coalesced += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        self._misses += 1
+        task = asyncio.ensure_future(fetch())
+        self._in_flight[key] = task
+        generation = self._generation
+
+
+        # Store the result once the fetch is done, even if every caller has stopped waiting on it
+        def fetch_done(task: asyncio.Future) -> None:
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+
+            if task.cancelled() or task.exception() is not None:
+                return
+
+            # The cache was invalidated while the fetch was in flight, so its result may be stale
+            if generation != self._generation:
+                return
+
+            if cache_if is None or cache_if(task.result()):
+                self.set(key, task.result())
+
+
+        task.add_done_callback(fetch_done)
+        return await asyncio.shield(task)
@@ -14,3 +14,85 @@ DISCORD_OWNER_ID: Final[int] = int(os.getenv("DISCORD_OWNER_ID"))
 SUBSONIC_SERVER: Final[str] = os.getenv("SUBSONIC_SERVER")
 SUBSONIC_USER: Final[str] = os.getenv("SUBSONIC_USER")
 SUBSONIC_PASSWORD: Final[str] = os.getenv("SUBSONIC_PASSWORD")
+
+# Optional tuning for connections to the Subsonic server
+SUBSONIC_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_TIMEOUT", "20"))
+SUBSONIC_CONNECT_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_CONNECT_TIMEOUT", "5"))
+SUBSONIC_KEEPALIVE_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_KEEPALIVE_TIMEOUT", "30"))
+SUBSONIC_MAX_CONNECTIONS: Final[int] = int(os.getenv("SUBSONIC_MAX_CONNECTIONS", "100"))
+SUBSONIC_MAX_CONNECTIONS_PER_HOST: Final[int] = int(os.getenv("SUBSONIC_MAX_CONNECTIONS_PER_HOST", "10"))
+SUBSONIC_TOKEN_ROTATION: Final[float] = float(os.getenv("SUBSONIC_TOKEN_ROTATION", "3600"))
+SUBSONIC_LEGACY_AUTH: Final[bool] = os.getenv("SUBSONIC_LEGACY_AUTH", "false").lower() == "true"
+SUBSONIC_CACHE_SIZE: Final[int] = int(os.getenv("SUBSONIC_CACHE_SIZE", "512"))
+SUBSONIC_CACHE_TTL: Final[float] = float(os.getenv("SUBSONIC_CACHE_TTL", "300"))
+
+# Optional tuning for the cover art cache
+COVER_CACHE_DIR: Final[str] = os.getenv("COVER_CACHE_DIR", "cache/covers")
+COVER_CACHE_MAX_BYTES: Final[int] = int(os.getenv("COVER_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+COVER_CACHE_MAX_AGE: Final[float] = float(os.getenv("COVER_CACHE_MAX_AGE", str(30 * 24 * 60 * 60)))
+COVER_CACHE_NEGATIVE_TTL: Final[float] = float(os.getenv("COVER_CACHE_NEGATIVE_TTL", "600"))
+COVER_CACHE_EVICTION_INTERVAL: Final[float] = float(os.getenv("COVER_CACHE_EVICTION_INTERVAL", "600"))
+THUMBNAIL_CACHE_SIZE: Final[int] = int(os.getenv("THUMBNAIL_CACHE_SIZE", "256"))
+THUMBNAIL_CACHE_TTL: Final[float] = float(os.getenv("THUMBNAIL_CACHE_TTL", "3600"))
+COVER_URL_EXPIRY_MARGIN: Final[float] = float(os.getenv("COVER_URL_EXPIRY_MARGIN", "3600"))
+COVER_URL_ASSUMED_LIFETIME: Final[float] = float(os.getenv("COVER_URL_ASSUMED_LIFETIME", "86400"))
+COVER_KEEP_ORIGINAL: Final[bool] = os.getenv("COVER_KEEP_ORIGINAL", "false").lower() == "true"
+THUMBNAIL_SIZE: Final[int] = int(os.getenv("THUMBNAIL_SIZE", "160"))
+THUMBNAIL_QUALITY: Final[int] = int(os.getenv("THUMBNAIL_QUALITY", "85"))
+THUMBNAIL_WORKERS: Final[int] = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+COVER_PREFETCH_CONCURRENCY: Final[int] = int(os.getenv("COVER_PREFETCH_CONCURRENCY", "4"))
+
+# Optional local library index
+LIBRARY_INDEX: Final[bool] = os.getenv("LIBRARY_INDEX", "false").lower() == "true"
+LIBRARY_INDEX_PATH: Final[str] = os.getenv("LIBRARY_INDEX_PATH", "cache/library.db")
+LIBRARY_SYNC_INTERVAL: Final[float] = float(os.getenv("LIBRARY_SYNC_INTERVAL", "3600"))
+LIBRARY_SYNC_CONCURRENCY: Final[int] = int(os.getenv("LIBRARY_SYNC_CONCURRENCY", "4"))
+
+# Optional tuning for /play autocomplete
+AUTOCOMPLETE_MAX_SONGS: Final[int] = int(os.getenv("AUTOCOMPLETE_MAX_SONGS", "20000"))
+AUTOCOMPLETE_DEBOUNCE: Final[float] = float(os.getenv("AUTOCOMPLETE_DEBOUNCE", "0.25"))
+AUTOCOMPLETE_DEADLINE: Final[float] = float(os.getenv("AUTOCOMPLETE_DEADLINE", "2"))
+
+# Optional cache of transcoded audio
+AUDIO_CACHE: Final[bool] = os.getenv("AUDIO_CACHE", "false").lower() == "true"
+AUDIO_CACHE_DIR: Final[str] = os.getenv("AUDIO_CACHE_DIR", "cache/audio")
+AUDIO_CACHE_MAX_BYTES: Final[int] = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Optional loudness analysis, replacing real-time normalization for measured songs
+LOUDNESS_ANALYSIS: Final[bool] = os.getenv("LOUDNESS_ANALYSIS", "false").lower() == "true"
+LOUDNESS_DB_PATH: Final[str] = os.getenv("LOUDNESS_DB_PATH", "cache/loudness.db")
+LOUDNESS_ANALYSIS_CONCURRENCY: Final[int] = int(os.getenv("LOUDNESS_ANALYSIS_CONCURRENCY", "1"))
+
+# Optional server-side transcoding to Opus, used for streams that don't need any filters
+SUBSONIC_TRANSCODE: Final[bool] = os.getenv("SUBSONIC_TRANSCODE", "false").lower() == "true"
+SUBSONIC_TRANSCODE_FORMAT: Final[str] = os.getenv("SUBSONIC_TRANSCODE_FORMAT", "opus")
+SUBSONIC_TRANSCODE_BITRATE: Final[int] = int(os.getenv("SUBSONIC_TRANSCODE_BITRATE", "128"))
+
+# Optional tuning for preparing the next track ahead of time
+PREWARM_LEAD: Final[float] = float(os.getenv("PREWARM_LEAD", "10"))
+PREWARM_BUFFER: Final[float] = float(os.getenv("PREWARM_BUFFER", "2"))
+
+# Optional tuning for the transcode scheduler
+TRANSCODE_MAX_CONCURRENT: Final[int] = int(os.getenv("TRANSCODE_MAX_CONCURRENT", "8"))
+TRANSCODE_QUEUE_TIMEOUT: Final[float] = float(os.getenv("TRANSCODE_QUEUE_TIMEOUT", "5"))
+TRANSCODE_DEGRADED_BITRATE: Final[int] = int(os.getenv("TRANSCODE_DEGRADED_BITRATE", "64"))
+TRANSCODE_NICE: Final[int] = int(os.getenv("TRANSCODE_NICE", "0"))
+TRANSCODE_CPUS: Final[set[int]] = {int(cpu) for cpu in os.getenv("TRANSCODE_CPUS", "").split(",") if cpu.strip() != ""}
+
+# Optional tuning for stations (shared listening sessions)
+STATION_LEAD: Final[float] = float(os.getenv("STATION_LEAD", "0.5"))
+STATION_BUFFER: Final[float] = float(os.getenv("STATION_BUFFER", "5"))
+
+# Optional in-process gain stage (requires NumPy), enabling live volume control
+PCM_GAIN_STAGE: Final[bool] = os.getenv("PCM_GAIN_STAGE", "false").lower() == "true"
+
+# Optional tuning for the read-ahead buffer between streams and voice clients (0 disables it)
+READ_AHEAD_BUFFER: Final[float] = float(os.getenv("READ_AHEAD_BUFFER", "1"))
+
+# Optional tuning for the ffmpeg process watchdog
+FFMPEG_WATCHDOG_INTERVAL: Final[float] = float(os.getenv("FFMPEG_WATCHDOG_INTERVAL", "10"))
+FFMPEG_STALL_TIMEOUT: Final[float] = float(os.getenv("FFMPEG_STALL_TIMEOUT", "30"))
+
+# Optional tuning for now-playing message updates
+NOW_PLAYING_INTERVAL: Final[float] = float(os.getenv("NOW_PLAYING_INTERVAL", "6"))
+NOW_PLAYING_MAX_EDIT_RATE: Final[float] = float(os.getenv("NOW_PLAYING_MAX_EDIT_RATE", "5"))
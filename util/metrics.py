@@ -0,0 +1,44 @@
+''' Process-wide metrics, reported through the owner commands '''
+
+import threading
+
+from typing import Callable
+
+
+class Metrics():
+    ''' A registry of named counters and gauges.\n
+        Counters may be incremented from any thread; gauges are read from a callback whenever a snapshot is taken.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[str, float] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+
+
+    def increment(self, name: str, amount: float=1) -> None:
+        ''' Increments a counter, creating it if necessary '''
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        ''' Registers a gauge, whose value is read from the given callback '''
+        self._gauges[name] = read
+
+
+    def snapshot(self) -> dict[str, float]:
+        ''' Returns the current value of every counter and gauge, by name '''
+
+        with self._lock:
+            values = dict(self._counters)
+
+        for name, read in self._gauges.items():
+            values[name] = read()
+
+        return dict(sorted(values.items()))
+
+
+
+metrics = Metrics()
@@ -0,0 +1,64 @@
+''' Helpers for paginated views '''
+
+import asyncio
+import logging
+
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache():
+    ''' Holds the pages fetched for a single paginated view, and fetches neighbouring pages ahead of time '''
+
+    def __init__(self, fetch_page: Callable[[int], Awaitable[list[Any]]]) -> None:
+        self._fetch_page = fetch_page
+        self._pages: dict[int, asyncio.Task] = {}
+
+
+    def _start_fetch(self, offset: int) -> asyncio.Task:
+        ''' Starts fetching the page at the given offset in the background '''
+
+        task = asyncio.create_task(self._fetch_page(offset), name=f"page_fetch_{offset}")
+        self._pages[offset] = task
+
+
+        # Forget failed fetches so they can be retried, and make sure their exceptions are retrieved
+        def fetch_done(task: asyncio.Task) -> None:
+            if task.cancelled():
+                return
+
+            if task.exception() is not None:
+                logger.warning("Failed to fetch page at offset %s: %s", offset, task.exception())
+                if self._pages.get(offset) is task:
+                    del self._pages[offset]
+
+
+        task.add_done_callback(fetch_done)
+        return task
+
+
+    async def get(self, offset: int) -> list[Any]:
+        ''' Returns the page at the given offset, waiting on (or starting) its fetch if necessary '''
+
+        task = self._pages.get(offset)
+        if task is None:
+            task = self._start_fetch(offset)
+
+        return await asyncio.shield(task)
+
+
+    def prefetch(self, offset: int) -> None:
+        ''' Fetches the page at the given offset in the background, if it hasn't been fetched already '''
+
+        if offset >= 0 and offset not in self._pages:
+            self._start_fetch(offset)
+
+
+    def clear(self) -> None:
+        ''' Cancels any pending fetches and forgets all pages '''
+
+        for task in self._pages.values():
+            task.cancel()
+
+        self._pages.clear()
@@ -0,0 +1,173 @@
+''' A process-wide scheduler refreshing widgets (like now-playing messages) on an interval, from a single task '''
+
+import asyncio
+import discord
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from typing import Awaitable, Callable
+
+from util import env
+from util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# The most the interval may be stretched by when refreshes are rate limited
+_MAX_BACKOFF = 8.0
+
+
+class RefreshScheduler():
+    ''' Refreshes widgets on an interval, keeping a queue of when each one is next due.\n
+        Refreshes are spread out to stay within a global rate, so the interval grows with the number of widgets, and it backs off
+        further while refreshes are being rate limited (see `note_rate_limited`). Each widget has at most one refresh in flight.
+    '''
+
+    def __init__(self, interval: float, max_rate: float) -> None:
+        self._base_interval = interval
+        self._max_rate = max_rate
+        self._backoff = 1.0
+        self._rate_limits = 0 # How many times refreshes were rate limited
+
+        self._refreshes: dict[any, Callable[[], Awaitable[bool]]] = {} # key -> refresh
+        self._due: dict[any, float] = {} # key -> when the next refresh is due
+        self._queue: list[tuple[float, int, any]] = [] # (due time, sequence, key), as a heap
+        self._sequence = itertools.count()
+        self._in_flight: set[any] = set()
+
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+
+    @property
+    def interval(self) -> float:
+        ''' The current interval between refreshes of a widget, in seconds. '''
+        return max(self._base_interval, len(self._refreshes) / self._max_rate) * self._backoff
+
+
+    @property
+    def widgets(self) -> int:
+        ''' The number of widgets being refreshed. '''
+        return len(self._refreshes)
+
+
+    def schedule(self, key: any, refresh: Callable[[], Awaitable[bool]]) -> None:
+        ''' Refreshes a widget on the interval, until its refresh returns False or it's unscheduled.\n
+            Scheduling a widget that's already scheduled only replaces its refresh.
+        '''
+
+        if key not in self._refreshes:
+            # Spread new widgets over the interval, so their refreshes don't line up
+            self._push(key, time.monotonic() + self.interval * random.uniform(0.5, 1.0))
+
+        self._refreshes[key] = refresh
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="refresh_scheduler_task")
+
+
+    def note_rate_limited(self) -> None:
+        ''' Records that a refresh was rate limited, backing the interval off '''
+
+        self._rate_limits += 1
+        self._backoff = min(_MAX_BACKOFF, self._backoff * 2)
+        metrics.increment("refreshes-rate-limited")
+
+
+    def unschedule(self, key: any) -> bool:
+        ''' Stops refreshing a widget, returning whether it was scheduled '''
+
+        self._due.pop(key, None)
+        return self._refreshes.pop(key, None) is not None
+
+
+    def _push(self, key: any, due: float) -> None:
+        ''' Queues a widget's next refresh (replacing any previously queued one) '''
+
+        self._due[key] = due
+        heapq.heappush(self._queue, (due, next(self._sequence), key))
+        self._wakeup.set()
+
+
+    async def _run(self) -> None:
+        ''' Starts refreshes as they become due, until there are no widgets left '''
+
+        try:
+            while len(self._refreshes) > 0:
+                self._wakeup.clear()
+
+                # Drop refreshes that were replaced or unscheduled
+                while len(self._queue) > 0 and self._due.get(self._queue[0][2]) != self._queue[0][0]:
+                    heapq.heappop(self._queue)
+
+                if len(self._queue) == 0:
+                    await self._wakeup.wait()
+                    continue
+
+                due, _, key = self._queue[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                heapq.heappop(self._queue)
+                del self._due[key]
+
+                # Never start a second refresh for the same widget; it's queued again once the current one finishes
+                if key not in self._in_flight:
+                    self._in_flight.add(key)
+                    asyncio.create_task(self._refresh(key, self._refreshes[key]), name="widget_refresh_task")
+
+                # Spread refreshes out, so they stay within the global rate
+                await asyncio.sleep(1 / self._max_rate)
+        finally:
+            self._task = None
+
+
+    async def _refresh(self, key: any, refresh: Callable[[], Awaitable[bool]]) -> None:
+        ''' Refreshes a widget, and queues its next refresh '''
+
+        keep = True
+        rate_limits = self._rate_limits
+
+        try:
+            keep = await refresh()
+        except discord.HTTPException as err:
+            if err.status == 429:
+                self.note_rate_limited()
+            logger.warning("Ignoring exception while refreshing widget '%s': %s", key, err)
+        except Exception as err:
+            logger.warning("Ignoring exception while refreshing widget '%s': %s", key, err)
+        finally:
+            self._in_flight.discard(key)
+
+        # Recover gradually from backing off, as long as refreshes aren't rate limited
+        if self._rate_limits == rate_limits:
+            self._backoff = max(1.0, self._backoff * 0.98)
+
+        metrics.increment("refreshes")
+
+        # The widget may have been unscheduled (or rescheduled with another refresh) in the meantime; bound methods are
+        # created anew every time they're accessed, so refreshes are compared by equality rather than identity
+        if self._refreshes.get(key) != refresh:
+            if key in self._refreshes and key not in self._due:
+                self._push(key, time.monotonic() + self.interval)
+            return
+
+        if keep is False:
+            self.unschedule(key)
+        elif key not in self._due:
+            self._push(key, time.monotonic() + self.interval)
+
+
+
+now_playing_scheduler = RefreshScheduler(env.NOW_PLAYING_INTERVAL, env.NOW_PLAYING_MAX_EDIT_RATE)
+
+metrics.register_gauge("now-playing-widgets", lambda: now_playing_scheduler.widgets)
+metrics.register_gauge("now-playing-interval", lambda: round(now_playing_scheduler.interval, 1))